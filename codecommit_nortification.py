@@ -9,27 +9,126 @@ This function is for nortificating Chatwork.
 Change Detail: Change python version from 2.7 to 3.7 and local variables to environment variables
 """
 
+import concurrent.futures
+import hashlib
 import json
 import os
+import threading
 import time
-
-from botocore.vendored import requests
-import boto3
+import uuid
+from collections import OrderedDict
+
+from botocore.config import Config
+
+from lambda_common import (
+    chat_time_left, claim_event, custom_print, flush_log, get_client, post_chatwork, release_event,
+    set_log_projections, start_chat, start_log
+)
+# Handler of the Chatwork outbox function, lambda_function.outbox_handler
+from lambda_common import outbox_handler
+
+# Fields of a payload written to the custom log, keyed by a top level key of the payload
+LOG_PROJECTIONS = {
+    'detail-type': [
+        ('id',), ('detail-type',), ('time',),
+        ('detail', 'event'), ('detail', 'callerUserArn'), ('detail', 'repositoryNames'),
+        ('detail', 'pullRequestId'), ('detail', 'pullRequestStatus'), ('detail', 'title'),
+        ('detail', 'sourceReference'), ('detail', 'destinationReference'), ('detail', 'sourceCommit'),
+        ('detail', 'commentId'), ('detail', 'afterCommitId')
+    ],
+    'Records': [
+        ('Records', 'eventId'), ('Records', 'eventSourceARN'), ('Records', 'userIdentityARN'),
+        ('Records', 'codecommit', 'references'), ('Records', 'messageId')
+    ]
+}
+set_log_projections(LOG_PROJECTIONS)
+
+# Pull request digest: length of a comment excerpt and lifetime of an entry in seconds
+DIGEST_EXCERPT = 80
+DIGEST_TTL = 24 * 60 * 60
+
+# Digest entries kept in this container when DIGEST_TABLE is not configured
+digest_local_store = {}
+
+# CodeCommit responses cached across warm invocations
+CACHE_MAX_ENTRIES = 256
+COMMENT_CACHE_TTL = 30
+BATCH_GET_COMMITS_MAX = 100
+
+# Changed files summary: files counted at most and paths listed
+CHANGED_FILES_MAX = 500
+CHANGED_FILES_TOP = 10
+cache_memory = OrderedDict()
+cache_stats = {'memory': 0, 'tmp': 0, 'miss': 0}
+cache_lock = threading.Lock()
+
+# Lookups of an event run at the same time, each bounded by ENRICH_TIMEOUT seconds.
+# Their CodeCommit client gives up within the same time, so a lookup left behind
+# does not keep a worker of the pool busy for the default 60 seconds read timeout
+ENRICH_TIMEOUT = 3
+ENRICH_CLIENT_CONFIG = Config(
+    tcp_keepalive=True, max_pool_connections=10,
+    connect_timeout=ENRICH_TIMEOUT, read_timeout=ENRICH_TIMEOUT,
+    retries={'max_attempts': 0}
+)
+enrich_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
 
 def lambda_handler(event, context):
     """
     lambda main
     """
-    custom_print('[START] Starting Script')
-    custom_print(event)
+    try:
+        start_log(context)
+        start_chat(context)
+        custom_print('[START] Starting Script')
+        custom_print(event)
+
+        # Chatwork initialize
+        url = os.environ['CHAT_URL']
+        chatwork_token = os.environ['TOKEN']
+        chatwork_room = os.environ['ROOM']
+
+        chatwork_url = '{0}/rooms/{1}/messages'.format(url, chatwork_room)
+        headers = {'X-ChatWorkToken': chatwork_token}
+
+        # A batch of EventBridge events delivered through SQS
+        response = 0
+        if event.get('Records') and event['Records'][0].get('eventSource') == 'aws:sqs':
+            response = handle_sqs_batch(event, chatwork_url, headers)
+        else:
+            handle_event(event, chatwork_url, headers)
+
+        # Post the digests whose window has passed. With DIGEST_TABLE the scheduled
+        # digest_handler does it; entries kept in this container can only be posted from here.
+        if int(os.environ.get('DIGEST_WINDOW', '0')) > 0 and not os.environ.get('DIGEST_TABLE'):
+            try:
+                flush_digests(headers)
+            except Exception as error:
+                # The events are already handled and claimed
+                custom_print('[ERROR] Could not post the digests: ' + str(error))
+
+        log_cache_stats()
+        custom_print('[FINISH] Finished running script')
+        return response
+    finally:
+        # Ship the custom log before the container is frozen
+        flush_log()
 
-    # Chatwork initialize
-    url = os.environ['CHAT_URL']
-    chatwork_token = os.environ['TOKEN']
-    chatwork_room = os.environ['ROOM']
+def handle_event(event, chatwork_url, headers):
+    """
+    Notify one CodeCommit event unless it was already handled.
+    Returns 2 when the notification failed.
 
-    chatwork_url = '{0}/rooms/{1}/messages'.format(url, chatwork_room)
-    headers = {'X-ChatWorkToken': chatwork_token}
+    Parameters
+    event: dict {EventBridge event or CodeCommit trigger event}
+    chatwork_url: str
+    headers: dict {TOKEN}
+    """
+    # Drop a delivery of an event that was already handled
+    event_key = get_event_key(event)
+    if not claim_event(event_key):
+        custom_print('[INFO] Duplicate delivery was dropped: ' + str(event_key))
+        return 0
 
     # notify codecommit push nortification
     found = 0
@@ -39,33 +138,132 @@ def lambda_handler(event, context):
         if key == 'source':
             found = 1
 
-    if found:
-        pull_request_env(event, chatwork_url, headers)
+    try:
+        if found:
+            result = pull_request_env(event, chatwork_url, headers)
 
-    # Was deployment trigger
-    else:
-        user = event['Records'][0]['userIdentityARN']
-        user = user.split(":")
+        # Was deployment trigger
+        else:
+            result = push_env(event, chatwork_url, headers)
+    except Exception:
+        release_event(event_key)
+        raise
 
-        source = event['Records'][0]['eventSourceARN']
-        source = source.split(":")
+    # Let a later delivery try again
+    if result == 2:
+        release_event(event_key)
+    return result
 
-        commit_id = event['Records'][0]['codecommit']['references'][0]['commit']
-        commit_detail = retrieve_commit(commit_id, source[5])
+def handle_sqs_batch(event, chatwork_url, headers):
+    """
+    Notify every EventBridge event of an SQS batch.
+    Clients, caches and the Chatwork connection are shared by the whole batch.
+    Only the messages that failed, or were not reached before the
+    time ran out, are reported back to SQS to be retried.
 
-        branch = event['Records'][0]['codecommit']['references'][0]['ref']
-        branch_name = branch.split("/")[2]
+    Parameters
+    event: dict {SQS event}
+    chatwork_url: str
+    headers: dict {TOKEN}
+    """
+    failures = []
+    for record in event['Records']:
+        if not chat_time_left(0):
+            custom_print('[WARNING] Out of time, message is left for retry: ' + record['messageId'])
+            failures.append({'itemIdentifier': record['messageId']})
+            continue
+
+        try:
+            envelope = json.loads(record['body'])
+            custom_print(envelope)
+            if handle_event(envelope, chatwork_url, headers) == 2:
+                failures.append({'itemIdentifier': record['messageId']})
+        except Exception as error:
+            custom_print('[ERROR] ' + record['messageId'] + ': ' + str(error))
+            failures.append({'itemIdentifier': record['messageId']})
+
+    custom_print('[INFO] Handled ' + str(len(event['Records']) - len(failures)) + ' messages, ' + str(len(failures)) + ' failed')
+    return {'batchItemFailures': failures}
+
+def digest_handler(event, context):
+    """
+    lambda main of the scheduled digest flush.
+    Posts the digests whose window has passed.
+    """
+    try:
+        start_log(context)
+        start_chat(context)
+        custom_print('[START] Starting Digest')
 
-        custom_print('[INFO] ' + str(user[5]) + ' has pushed to ' + str(source[5]) + ' repository ' + branch_name + " branch ")
-        requests.post(chatwork_url, headers=headers, params={
-            'body': branch_name + " ブランチに"
-            '\n' + str(user[5]) + ' が自動デプロイを実行しました。' +
-            '\n' + str(source[5]) + ' から反映中ですので少々お待ちください。' +
-            '\n\n' + 'デプロイ内容: \n' + str(commit_detail['commit']['message'])
-        })
+        headers = {'X-ChatWorkToken': os.environ['TOKEN']}
+        posted = flush_digests(headers)
 
-    custom_print('[FINISH] Finished running script')
-    return 0
+        custom_print('[FINISH] Posted ' + str(posted) + ' digests')
+        return 0
+    finally:
+        # Ship the custom log before the container is frozen
+        flush_log()
+
+def push_env(event, chatwork_url, headers):
+    """
+    Notify deployment nortification of a CodeCommit trigger.
+    Every record and every pushed reference is notified,
+    one message per branch, and the commits of each repository
+    are retrieved with a single batch call.
+
+    Parameters
+    event: dict {CodeCommit trigger event}
+    chatwork_url: str
+    headers: dict {TOKEN}
+    """
+    try:
+        # Collect the pushed references of every record, per branch
+        branches = OrderedDict()
+        commit_ids = OrderedDict()
+        for record in event['Records']:
+            user = record['userIdentityARN'].split(':')
+            source = record['eventSourceARN'].split(':')
+
+            for reference in record['codecommit']['references']:
+                if reference.get('deleted'):
+                    continue
+                branch = branches.setdefault((source[5], reference['ref']), {'users': [], 'commits': []})
+                if user[5] not in branch['users']:
+                    branch['users'].append(user[5])
+                branch['commits'].append(reference['commit'])
+                commit_ids.setdefault(source[5], []).append(reference['commit'])
+
+        commits = {}
+        for repository, repository_commit_ids in commit_ids.items():
+            commits.update(retrieve_commits(repository_commit_ids, repository))
+
+        for (repository, ref), branch in branches.items():
+            branch_name = ref.split('/', 2)[2]
+            users = '、'.join(branch['users'])
+            messages = [str(commits[commit_id]['message']) for commit_id in branch['commits'] if commit_id in commits]
+
+            # The trigger carries the head commit of the reference, not every pushed commit,
+            # so the summary covers the changes of the head commit against its parent
+            enriched = {}
+            if os.environ.get('CHANGED_FILES_SUMMARY') == 'true':
+                head_commit = commits.get(branch['commits'][-1], {})
+                parents = head_commit.get('parents') or [None]
+                enriched = enrich_event({
+                    'changes': (summarize_changes, (repository, parents[0], branch['commits'][-1]))
+                })
+
+            custom_print('[INFO] ' + users + ' has pushed to ' + repository + ' repository ' + branch_name + ' branch')
+            post_chatwork(chatwork_url, headers,
+                branch_name + " ブランチに"
+                '\n' + users + ' が自動デプロイを実行しました。' +
+                '\n' + repository + ' から反映中ですので少々お待ちください。' +
+                '\n\n' + 'デプロイ内容: \n' + '\n\n'.join(messages) +
+                format_changes(enriched, '最新コミットの変更ファイル')
+            )
+
+    except Exception as error:
+        custom_print('[ERROR] ' + str(error))
+        return 2
 
 def pull_request_env(event, chatwork_url, headers):
     """
@@ -113,45 +311,57 @@ def pull_request_env(event, chatwork_url, headers):
             # New pull request was created
             if pull_event == 'pullRequestCreated':
                 custom_print('[INFO] ' + str(user[5]) + ' has created a new pull request. ID: ' + str(pull_id))
-                requests.post(chatwork_url, headers=headers, params={
-                    'body': str(user[5]) + ' が新規にプルリク (' + str(pull_id) + ') を作成しました。' +
+                entry = {'kind': 'state', 'user': str(user[5]), 'text': '新規に作成しました。', 'title': pull_title, 'url': pull_url}
+                notify_pull_request(chatwork_url, headers, pull_id, entry,
+                    str(user[5]) + ' が新規にプルリク (' + str(pull_id) + ') を作成しました。' +
                     '\n\nタイトル: ' + str(pull_title) +
                     '\n内容: ' + str(pull_description) +
                     '\nブランチ: ' + str(source_ref[2]) + ' → '  + str(destination_ref[2]) +
                     '\n\n' + pull_url
-                })
+                )
             # Pull was closed without merging
             elif pull_event == 'pullRequestStatusChanged':
                 custom_print('[INFO] ' + str(user[5]) + ' has closed without merging a pull request. ID: ' + str(pull_id))
-                requests.post(chatwork_url, headers=headers, params={
-                    'body': str(user[5]) + ' がマージせずにプルリク (' + str(pull_id) + ') をクローズしました。' +
+                entry = {'kind': 'state', 'user': str(user[5]), 'text': 'マージせずにクローズしました。', 'title': pull_title, 'url': pull_url}
+                notify_pull_request(chatwork_url, headers, pull_id, entry,
+                    str(user[5]) + ' がマージせずにプルリク (' + str(pull_id) + ') をクローズしました。' +
                     '\n\nタイトル: ' + str(pull_title) +
                     '\n内容: ' + str(pull_description) +
                     '\nブランチ: ' + str(source_ref[2]) + ' → '  + str(destination_ref[2]) +
                     '\n\n' + pull_url
-                })
+                )
             # Closed a pull with merging
             elif pull_event == 'pullRequestMergeStatusUpdated':
                 custom_print('[INFO] ' + str(user[5]) + ' has merged a pull request. ID: ' + str(pull_id))
-                requests.post(chatwork_url, headers=headers, params={
-                    'body': str(user[5]) + ' がマージを行いプルリク (' + str(pull_id) + ') をクローズしました。' +
+                entry = {'kind': 'state', 'user': str(user[5]), 'text': 'マージを行いクローズしました。', 'title': pull_title, 'url': pull_url}
+                notify_pull_request(chatwork_url, headers, pull_id, entry,
+                    str(user[5]) + ' がマージを行いプルリク (' + str(pull_id) + ') をクローズしました。' +
                     '\n\nタイトル: ' + str(pull_title) +
                     '\n内容: ' + str(pull_description) +
                     '\nブランチ: ' + str(source_ref[2]) + ' → '  + str(destination_ref[2]) +
                     '\n\n' + pull_url
-                })
+                )
             # Pushed to non master branch
             elif pull_event == 'pullRequestSourceBranchUpdated':
                 commit_id = event['detail']['sourceCommit']
+                repository = event['detail']['repositoryNames'][0]
+                lookups = {'commit': (retrieve_commit, (commit_id, repository))}
+                if os.environ.get('CHANGED_FILES_SUMMARY') == 'true':
+                    base_commit = event['detail'].get('mergeBase') or event['detail'].get('destinationCommit')
+                    lookups['changes'] = (summarize_changes, (repository, base_commit, commit_id))
+                enriched = enrich_event(lookups)
                 custom_print('[INFO] ' + str(user[5]) + ' has pushed to non master branch. ID: ' + str(pull_id))
-                requests.post(chatwork_url, headers=headers, params={
-                    'body': str(user[5]) + ' が ' + str(source_ref[2])+' のブランチにコミットしました。プルリク (' + str(pull_id) + ')' +
+                entry = {'kind': 'commit', 'user': str(user[5]), 'text': str(commit_id), 'title': pull_title, 'url': pull_url}
+                notify_pull_request(chatwork_url, headers, pull_id, entry,
+                    str(user[5]) + ' が ' + str(source_ref[2])+' のブランチにコミットしました。プルリク (' + str(pull_id) + ')' +
                     '\n\nタイトル: ' + str(pull_title) +
                     '\n内容: ' + str(pull_description) +
                     '\nブランチ: ' + str(source_ref[2]) + ' → '  + str(destination_ref[2]) +
                     '\nコミットID: ' +str(commit_id) +
+                    format_commit_detail(enriched) +
+                    format_changes(enriched) +
                     '\n\n' + pull_url
-                })
+                )
             # Other events detected not sent
             else:
                 custom_print('[INFO] No notification sent. Pull Event: ' + str(pull_event) + ' PullID: ' + str(pull_id))
@@ -164,16 +374,29 @@ def pull_request_env(event, chatwork_url, headers):
             pull_id = event['detail']['pullRequestId']
             pull_url = base_url + "pull-requests/" + pull_id + "/activity?region=ap-northeast-1#" + comment_id
 
-            comment_response = retrieve_comment(comment_id)
-
             # New comments added
             if pull_event == 'commentOnPullRequestCreated':
+                enriched = enrich_event({
+                    'comment': (retrieve_comment, (comment_id,)),
+                    'pull_request': (retrieve_pull_request, (pull_id,))
+                })
                 custom_print('[INFO] comment added to PullID: ' + str(pull_id))
-                requests.post(chatwork_url, headers=headers, params={
-                    'body': str(user[5]) + ' がプルリク (' + str(pull_id) + ') にコメントしました。' +
-                    '\n\nコメント:\n' + comment_response['comment']['content'] +
+
+                pull_title = None
+                if 'pull_request' in enriched:
+                    pull_title = enriched['pull_request']['pullRequest']['title']
+                comment = get_comment_content(enriched)
+                excerpt = comment
+                if len(excerpt) > DIGEST_EXCERPT:
+                    excerpt = excerpt[:DIGEST_EXCERPT] + '…'
+
+                entry = {'kind': 'comment', 'user': str(user[5]), 'text': excerpt, 'title': pull_title, 'url': pull_url}
+                notify_pull_request(chatwork_url, headers, pull_id, entry,
+                    str(user[5]) + ' がプルリク (' + str(pull_id) + ') にコメントしました。' +
+                    ('\n\nタイトル: ' + str(pull_title) if pull_title else '') +
+                    '\n\nコメント:\n' + comment +
                     '\n\n' + pull_url
-                })
+                )
 
             else:
                 custom_print('[INFO] No notification sent. Pull Event: ' + str(pull_event) + ' PullID: ' + str(pull_id))
@@ -185,15 +408,19 @@ def pull_request_env(event, chatwork_url, headers):
 
             pull_url = base_url + "commit/" + after_commit_id + "?region=ap-northeast-1#" +comment_id
 
-            comment_response = retrieve_comment(comment_id)
+            enriched = enrich_event({
+                'comment': (retrieve_comment, (comment_id,)),
+                'commit': (retrieve_commit, (after_commit_id, event['detail']['repositoryName']))
+            })
 
             custom_print('[INFO] comment added')
-            requests.post(chatwork_url, headers=headers, params={
-                'body': str(user[5]) + ' がコミットにコメントしました。' +
+            post_chatwork(chatwork_url, headers,
+                str(user[5]) + ' がコミットにコメントしました。' +
                 '\n\nコミットID: ' + after_commit_id +
-                '\nコメント:\n' + comment_response['comment']['content'] +
+                format_commit_detail(enriched) +
+                '\nコメント:\n' + get_comment_content(enriched) +
                 '\n\n' + pull_url
-            })
+            )
 
         # Other events detected not sent
         else:
@@ -203,108 +430,516 @@ def pull_request_env(event, chatwork_url, headers):
         custom_print('[ERROR] ' + str(error))
         return 2
 
+def enrich_event(lookups):
+    """
+    Run the lookups an event needs at the same time on the thread pool.
+    Returns the results that arrived within ENRICH_TIMEOUT seconds;
+    a lookup that failed or was late is left out, so the message
+    is built from the fields that are available.
+
+    Parameters
+    lookups: dict {name: (function, args)}
+    """
+    futures = {}
+    for name, (function, args) in lookups.items():
+        futures[name] = enrich_pool.submit(function, *args)
+
+    done, not_done = concurrent.futures.wait(list(futures.values()), timeout=ENRICH_TIMEOUT)
+
+    enriched = {}
+    for name, future in futures.items():
+        if future not in done:
+            custom_print('[WARNING] ' + name + ' lookup did not finish within ' + str(ENRICH_TIMEOUT) + ' seconds')
+        elif future.exception() is not None or future.result() == 2:
+            custom_print('[WARNING] ' + name + ' lookup failed')
+        else:
+            enriched[name] = future.result()
+    return enriched
+
+def get_comment_content(enriched):
+    """
+    Content of the enriched comment.
+
+    Parameters
+    enriched: dict result of enrich_event
+    """
+    if 'comment' in enriched:
+        return enriched['comment']['comment'].get('content', '')
+    return '（取得できませんでした）'
+
+def format_commit_detail(enriched):
+    """
+    Commit message and author lines of the enriched commit,
+    empty when the commit did not arrive.
+
+    Parameters
+    enriched: dict result of enrich_event
+    """
+    if 'commit' not in enriched:
+        return ''
+    commit = enriched['commit']['commit']
+    return ('\nコミット作成者: ' + str(commit.get('author', {}).get('name')) +
+            '\nコミットメッセージ: ' + str(commit.get('message', '')).strip())
+
+def summarize_changes(repository, before_commit, after_commit):
+    """
+    Summary of the files changed between two commits:
+    counts per change type and the first CHANGED_FILES_TOP paths.
+    Differences are read page by page and reading stops once
+    CHANGED_FILES_MAX files were counted, so a large diff is never
+    held in memory. Summaries are cached per commit pair.
+
+    Parameters
+    repository: str
+    before_commit: str None compares with the empty tree
+    after_commit: str
+    """
+    try:
+        cache_key = 'changes:' + str(repository) + ':' + str(before_commit) + ':' + str(after_commit)
+        summary = cache_get(cache_key)
+        if summary is None:
+            summary = {'counts': {'A': 0, 'M': 0, 'D': 0}, 'paths': [], 'truncated': False}
+            counted = 0
+            for difference in iter_differences(repository, before_commit, after_commit):
+                if counted >= CHANGED_FILES_MAX:
+                    summary['truncated'] = True
+                    break
+                counted += 1
+
+                change_type = difference.get('changeType', 'M')
+                summary['counts'][change_type] = summary['counts'].get(change_type, 0) + 1
+                if len(summary['paths']) < CHANGED_FILES_TOP:
+                    blob = difference.get('afterBlob') or difference.get('beforeBlob') or {}
+                    summary['paths'].append(change_type + ' ' + str(blob.get('path')))
+            cache_put(cache_key, summary)
+        return summary
+    except Exception as error:
+        custom_print('[ERROR] ' + str(error))
+        return 2
+
+def iter_differences(repository, before_commit, after_commit):
+    """
+    Yield the differences between two commits one page at a time.
+
+    Parameters
+    repository: str
+    before_commit: str None compares with the empty tree
+    after_commit: str
+    """
+    request = {
+        'repositoryName': repository,
+        'afterCommitSpecifier': after_commit
+    }
+    if before_commit:
+        request['beforeCommitSpecifier'] = before_commit
+
+    paginator = get_client('codecommit', config=ENRICH_CLIENT_CONFIG).get_paginator('get_differences')
+    for page in paginator.paginate(**request):
+        for difference in page.get('differences', []):
+            yield difference
+
+def format_changes(enriched, label='変更ファイル'):
+    """
+    Changed files lines of the enriched summary,
+    empty when the summary is disabled or did not arrive.
+    A truncated summary is marked once, with the number of files counted.
+
+    Parameters
+    enriched: dict result of enrich_event
+    label: str heading of the lines
+    """
+    if 'changes' not in enriched:
+        return ''
+    summary = enriched['changes']
+    text = ('\n' + label + ': 追加 ' + str(summary['counts'].get('A', 0)) +
+            ' / 変更 ' + str(summary['counts'].get('M', 0)) +
+            ' / 削除 ' + str(summary['counts'].get('D', 0)))
+    if summary['truncated']:
+        text += ' (' + str(sum(summary['counts'].values())) + ' 件以上、先頭のみ集計)'
+    for path in summary['paths']:
+        text += '\n  ' + path
+    return text
+
+def notify_pull_request(chatwork_url, headers, pull_id, entry, body):
+    """
+    Post the pull request message now, or add it to the digest
+    of the pull request when DIGEST_WINDOW is set.
+    The full message is kept with the entry so that a digest
+    of a single event is posted as it is.
+
+    Parameters
+    chatwork_url: str
+    headers: dict {TOKEN}
+    pull_id: str
+    entry: dict {kind, user, text, title, url} digest entry
+    body: str message posted when not digested
+    """
+    if int(os.environ.get('DIGEST_WINDOW', '0')) > 0:
+        add_digest_entry(os.environ['ROOM'], pull_id, dict(entry, body=body))
+        custom_print('[INFO] Added ' + entry['kind'] + ' to the digest of PullID: ' + str(pull_id))
+    else:
+        post_chatwork(chatwork_url, headers, body)
+
+def add_digest_entry(room, pull_id, entry):
+    """
+    Store an entry in the digest of (room, pull request).
+    Entries go to the DIGEST_TABLE DynamoDB table, or stay in this
+    container when no table is configured (local runs and tests).
+
+    Parameters
+    room: str Chatwork room id
+    pull_id: str
+    entry: dict {kind, user, text, title, url, body}
+    """
+    digest_key = str(room) + '#' + str(pull_id)
+    entry_key = '%013d#%s' % (int(time.time() * 1000), uuid.uuid4().hex)
+    table_name = os.environ.get('DIGEST_TABLE')
+
+    if not table_name:
+        digest_local_store.setdefault(digest_key, []).append((entry_key, entry))
+        return
+
+    get_client('dynamodb').put_item(
+        TableName=table_name,
+        Item={
+            'digest_key': {'S': digest_key},
+            'entry_key': {'S': entry_key},
+            'entry': {'S': json.dumps(entry)},
+            'expires_at': {'N': str(int(time.time()) + DIGEST_TTL)}
+        }
+    )
+
+def flush_digests(headers):
+    """
+    Post one combined message for every digest whose first entry
+    is older than DIGEST_WINDOW seconds. Returns the number posted.
+    A digest of a single entry is posted as its full message.
+
+    Parameters
+    headers: dict {TOKEN}
+    """
+    window = int(os.environ.get('DIGEST_WINDOW', '0'))
+    due_time = '%013d' % int((time.time() - window) * 1000)
+    posted = 0
+
+    for digest_key, entry_keys in list_digests().items():
+        if min(entry_keys) > due_time:
+            continue
+
+        entries = take_digest_entries(digest_key, entry_keys)
+        if not entries:
+            continue
+
+        room, pull_id = digest_key.split('#', 1)
+        chatwork_url = '{0}/rooms/{1}/messages'.format(os.environ['CHAT_URL'], room)
+        custom_print('[INFO] Posting digest of ' + str(len(entries)) + ' events for PullID: ' + str(pull_id))
+        if len(entries) == 1 and entries[0].get('body'):
+            post_chatwork(chatwork_url, headers, entries[0]['body'])
+        else:
+            post_chatwork(chatwork_url, headers, render_digest(pull_id, entries))
+        posted += 1
+
+    return posted
+
+def list_digests():
+    """
+    Entry keys of every pending digest, keyed by digest key.
+    """
+    table_name = os.environ.get('DIGEST_TABLE')
+    if not table_name:
+        return dict((digest_key, [entry_key for entry_key, entry in entries])
+                    for digest_key, entries in digest_local_store.items() if entries)
+
+    digests = {}
+    paginator = get_client('dynamodb').get_paginator('scan')
+    for page in paginator.paginate(TableName=table_name, ProjectionExpression='digest_key, entry_key'):
+        for item in page['Items']:
+            digests.setdefault(item['digest_key']['S'], []).append(item['entry_key']['S'])
+    return digests
+
+def take_digest_entries(digest_key, entry_keys):
+    """
+    Remove the entries from the store and return them in time order.
+    Only entries this call actually deleted are returned, so two
+    concurrent flushes never post the same entry twice.
+
+    Parameters
+    digest_key: str
+    entry_keys: list [str]
+    """
+    table_name = os.environ.get('DIGEST_TABLE')
+    if not table_name:
+        return [entry for entry_key, entry in sorted(digest_local_store.pop(digest_key, []), key=lambda item: item[0])]
+
+    taken = []
+    dynamodb_client = get_client('dynamodb')
+    for entry_key in sorted(entry_keys):
+        response = dynamodb_client.delete_item(
+            TableName=table_name,
+            Key={'digest_key': {'S': digest_key}, 'entry_key': {'S': entry_key}},
+            ReturnValues='ALL_OLD'
+        )
+        if 'Attributes' in response:
+            taken.append(json.loads(response['Attributes']['entry']['S']))
+    return taken
+
+def render_digest(pull_id, entries):
+    """
+    Combined Chatwork message of the digest entries.
+
+    Parameters
+    pull_id: str
+    entries: list [{kind, user, text, title, url}] in time order
+    """
+    body = 'プルリク (' + str(pull_id) + ') の更新まとめ (' + str(len(entries)) + ' 件)'
+
+    titles = [entry['title'] for entry in entries if entry.get('title')]
+    if titles:
+        body += '\n\nタイトル: ' + titles[-1]
+
+    states = [entry for entry in entries if entry['kind'] == 'state']
+    if states:
+        body += '\n\n状態:'
+        for entry in states:
+            body += '\n' + entry['user'] + ' が' + entry['text']
+
+    commits = [entry for entry in entries if entry['kind'] == 'commit']
+    if commits:
+        body += '\n\nコミット (' + str(len(commits)) + ' 件):'
+        for entry in commits:
+            body += '\n' + entry['text'] + ' (' + entry['user'] + ')'
+
+    comments = [entry for entry in entries if entry['kind'] == 'comment']
+    if comments:
+        body += '\n\nコメント (' + str(len(comments)) + ' 件):'
+        for entry in comments:
+            body += '\n' + entry['user'] + ': ' + entry['text']
+
+    return body + '\n\n' + entries[-1]['url']
 
 def retrieve_commit(commit_id, source):
     """
     Retrieve commit description.
+    Commits never change, so a cached commit never expires.
 
     Parameters
     commit_id: str
     source: str "Source ARN"
     """
     try:
-        cc_client = boto3.client('codecommit')
-        response = cc_client.get_commit(
-            commitId=commit_id,
-            repositoryName=source
-        )
+        cache_key = 'commit:' + str(source) + ':' + str(commit_id)
+        response = cache_get(cache_key)
+        if response is None:
+            cc_client = get_client('codecommit', config=ENRICH_CLIENT_CONFIG)
+            response = cc_client.get_commit(
+                commitId=commit_id,
+                repositoryName=source
+            )
+            response.pop('ResponseMetadata', None)
+            cache_put(cache_key, response)
         return response
     except Exception as error:
         custom_print('[ERROR] ' + str(error))
         return 2
 
 
+def retrieve_commits(commit_ids, source):
+    """
+    Retrieve the descriptions of many commits of one repository.
+    Cached commits are reused and the rest are fetched with
+    batch_get_commits, BATCH_GET_COMMITS_MAX at a time.
+    Returns {commitId: commit}.
+
+    Parameters
+    commit_ids: list [str]
+    source: str "Source ARN"
+    """
+    commits = {}
+    missing = []
+    for commit_id in commit_ids:
+        cached = cache_get('commit:' + str(source) + ':' + str(commit_id))
+        if cached is not None:
+            commits[commit_id] = cached['commit']
+        elif commit_id not in missing:
+            missing.append(commit_id)
+
+    cc_client = get_client('codecommit')
+    for index in range(0, len(missing), BATCH_GET_COMMITS_MAX):
+        response = cc_client.batch_get_commits(
+            commitIds=missing[index:index + BATCH_GET_COMMITS_MAX],
+            repositoryName=source
+        )
+        for commit in response['commits']:
+            commits[commit['commitId']] = commit
+            cache_put('commit:' + str(source) + ':' + commit['commitId'], {'commit': commit})
+        for error in response.get('errors', []):
+            custom_print('[ERROR] ' + str(error.get('commitId')) + ': ' + str(error.get('errorMessage')))
+
+    return commits
+
+
 def retrieve_comment(comment_id):
     """
     Retrieve comment description
+    A comment can be edited, so it is only cached for COMMENT_CACHE_TTL seconds.
 
     Parameters
     comment_id: str
     """
     try:
-        cc_client = boto3.client('codecommit')
-        response = cc_client.get_comment(
-            commentId=comment_id
-        )
+        cache_key = 'comment:' + str(comment_id)
+        response = cache_get(cache_key, COMMENT_CACHE_TTL)
+        if response is None:
+            cc_client = get_client('codecommit', config=ENRICH_CLIENT_CONFIG)
+            response = cc_client.get_comment(
+                commentId=comment_id
+            )
+            response.pop('ResponseMetadata', None)
+            cache_put(cache_key, response)
         return response
     except Exception as error:
         custom_print('[ERROR] ' + str(error))
         return 2
 
 
-def custom_print(msg):
+def retrieve_pull_request(pull_id):
     """
-    AWS Lambda does not put logs in continous matter.
-    If you want to have a continous log, you need to create
-    your own log and put it inside that log.
-    Also, this will determine is the response is JSON
-    and print it in JSON format for easier read.
+    Retrieve pull request description.
+    Title and status can change, so it is only cached for COMMENT_CACHE_TTL seconds.
 
     Parameters
-    msg: str
+    pull_id: str
     """
-    # If the message is a json format, print the result in json
-    # to make it easier to read.
-    if isinstance(msg, str):
-        msg = msg
-        print(msg)
-    else:
-        msgjson = json.dumps(msg, sort_keys=True, default=str)
-        msg = '[RESPONSE]\n' + msgjson
-        print('[RESPONSE] ' + msgjson)
-    # Time since EPOCH
-    time_stamp_milli = int(round(time.time() * 1000))
-
-    # Initialize
-    log_group_name = os.environ['CUSTOM_LOG_GROUP']
-    log_stream_name = os.environ['CUSTOM_LOG_STREAM']
-    region = os.environ['AWS_REGION']
-    log_client = boto3.client('logs', region_name=region)
-
-    # Obtain the response and check if token exists
-    log_response = log_client.describe_log_streams(
-        logGroupName=log_group_name,
-        logStreamNamePrefix=log_stream_name)['logStreams'][0]
-    found = 0
-    for key in log_response.keys():
-        if key == 'uploadSequenceToken':
-            found = 1
+    try:
+        cache_key = 'pull_request:' + str(pull_id)
+        response = cache_get(cache_key, COMMENT_CACHE_TTL)
+        if response is None:
+            cc_client = get_client('codecommit', config=ENRICH_CLIENT_CONFIG)
+            response = cc_client.get_pull_request(
+                pullRequestId=pull_id
+            )
+            response.pop('ResponseMetadata', None)
+            cache_put(cache_key, response)
+        return response
+    except Exception as error:
+        custom_print('[ERROR] ' + str(error))
+        return 2
 
-    # If token does exists, the log already has entry; append to the log with token
-    if found:
-        upload_token = log_client.describe_log_streams(
-            logGroupName=log_group_name,
-            logStreamNamePrefix=log_stream_name)['logStreams'][0]['uploadSequenceToken']
-        response = log_client.put_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream_name,
-            logEvents=[
-                {
-                    'timestamp': time_stamp_milli,
-                    'message': msg
-                }
-            ],
-            sequenceToken=upload_token
-        )
-    # This log entry is absolutely new, therefore no need of token
-    else:
-        response = log_client.put_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream_name,
-            logEvents=[
-                {
-                    'timestamp': time_stamp_milli,
-                    'message': msg
-                }
-            ]
-        )
+
+def cache_get(key, ttl=None):
+    """
+    Cached CodeCommit response, or None.
+    Looks in the in-process LRU first, then in the /tmp store
+    that survives as long as the container when CODECOMMIT_CACHE_DIR is set.
+
+    Parameters
+    key: str
+    ttl: int seconds, None never expires
+    """
+    now = time.time()
+    with cache_lock:
+        if key in cache_memory:
+            stored_at, value = cache_memory[key]
+            if ttl is None or now - stored_at <= ttl:
+                cache_memory.move_to_end(key)
+                cache_stats['memory'] += 1
+                return value
+            del cache_memory[key]
+
+    cache_dir = os.environ.get('CODECOMMIT_CACHE_DIR')
+    if cache_dir:
+        try:
+            with open(get_cache_path(cache_dir, key)) as cache_file:
+                stored = json.load(cache_file)
+            if ttl is None or now - stored['stored_at'] <= ttl:
+                remember_cache(key, stored['stored_at'], stored['value'])
+                with cache_lock:
+                    cache_stats['tmp'] += 1
+                return stored['value']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    with cache_lock:
+        cache_stats['miss'] += 1
+    return None
+
+def cache_put(key, value):
+    """
+    Store a CodeCommit response in the LRU and the /tmp store.
+
+    Parameters
+    key: str
+    value: dict
+    """
+    now = time.time()
+    remember_cache(key, now, value)
+
+    cache_dir = os.environ.get('CODECOMMIT_CACHE_DIR')
+    if cache_dir:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_path = get_cache_path(cache_dir, key)
+            # Write aside and rename so a reader never sees half a file
+            with open(cache_path + '.' + uuid.uuid4().hex, 'w') as cache_file:
+                json.dump({'stored_at': now, 'value': value}, cache_file, default=str)
+                temp_path = cache_file.name
+            os.replace(temp_path, cache_path)
+        except OSError as error:
+            custom_print('[WARNING] Could not write the CodeCommit cache: ' + str(error))
+
+def remember_cache(key, stored_at, value):
+    """
+    Put an entry in the LRU and evict the least recently used ones.
+
+    Parameters
+    key: str
+    stored_at: float seconds since EPOCH
+    value: dict
+    """
+    with cache_lock:
+        cache_memory[key] = (stored_at, value)
+        cache_memory.move_to_end(key)
+        while len(cache_memory) > CACHE_MAX_ENTRIES:
+            cache_memory.popitem(last=False)
+
+def get_cache_path(cache_dir, key):
+    """
+    File of the key in the /tmp store.
+
+    Parameters
+    cache_dir: str
+    key: str
+    """
+    return os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+def log_cache_stats():
+    """
+    Log the cache hits and misses of this invocation and reset them.
+    """
+    with cache_lock:
+        custom_print('[INFO] CodeCommit cache memory hit: ' + str(cache_stats['memory']) +
+                     ' tmp hit: ' + str(cache_stats['tmp']) + ' miss: ' + str(cache_stats['miss']))
+        for name in cache_stats:
+            cache_stats[name] = 0
+
+def get_event_key(event):
+    """
+    Key identifying an event across its deliveries:
+    the EventBridge event id, or the record ids of a CodeCommit trigger.
+
+    Parameters
+    event: dict
+    """
+    if 'id' in event:
+        return 'event:' + str(event['id'])
+
+    event_ids = [str(record.get('eventId')) for record in event.get('Records', [])]
+    if event_ids:
+        return 'codecommit:' + hashlib.sha1(','.join(event_ids).encode('utf-8')).hexdigest()
+    return None
+
+# Build the clients during the init phase so it falls outside billed duration
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    for init_service in ('logs', 'codecommit'):
+        get_client(init_service)
+    get_client('codecommit', config=ENRICH_CLIENT_CONFIG)
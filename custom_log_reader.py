@@ -0,0 +1,99 @@
+"""
+Command line utility that reads the custom log written by custom_print.
+When CUSTOM_LOG_STREAM_MODE is 'container' or 'invocation' each container
+writes to its own stream under CUSTOM_LOG_STREAM/. This merges those shards
+back into one continous log in time order.
+
+Usage: python custom_log_reader.py LOG_GROUP LOG_STREAM_PREFIX [--minutes 60]
+"""
+
+import argparse
+import heapq
+import time
+
+import boto3
+
+def main():
+    """
+    command line main
+    """
+    parser = argparse.ArgumentParser(description='Merge custom log stream shards in time order')
+    parser.add_argument('log_group', help='CUSTOM_LOG_GROUP of the function')
+    parser.add_argument('log_stream_prefix', help='CUSTOM_LOG_STREAM of the function')
+    parser.add_argument('--minutes', type=int, default=60, help='how far back to read')
+    parser.add_argument('--region', default=None)
+    args = parser.parse_args()
+
+    log_client = boto3.client('logs', region_name=args.region)
+    start_time = int(round((time.time() - args.minutes * 60) * 1000))
+
+    for log_event in merge_log_streams(log_client, args.log_group, args.log_stream_prefix, start_time):
+        print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(log_event['timestamp'] / 1000))
+              + ' ' + log_event['logStreamName'] + ' ' + log_event['message'])
+
+    return 0
+
+def merge_log_streams(log_client, log_group_name, log_stream_prefix, start_time):
+    """
+    Yield the events of every stream under the prefix in time order.
+    Each stream is already ordered, so they are merged lazily
+    instead of loading every event into memory.
+
+    Parameters
+    log_client: boto3 logs client
+    log_group_name: str
+    log_stream_prefix: str
+    start_time: int milliseconds since EPOCH
+    """
+    readers = []
+    for log_stream_name in list_log_streams(log_client, log_group_name, log_stream_prefix):
+        readers.append(read_log_stream(log_client, log_group_name, log_stream_name, start_time))
+
+    return heapq.merge(*readers, key=lambda log_event: (log_event['timestamp'], log_event['ingestionTime']))
+
+def list_log_streams(log_client, log_group_name, log_stream_prefix):
+    """
+    Names of every stream under the prefix.
+    lastEventTimestamp is updated lazily by CloudWatch Logs and a container
+    stream can be older than the time read from, so no stream is left out here;
+    read_log_stream skips the events before the start time.
+
+    Parameters
+    log_client: boto3 logs client
+    log_group_name: str
+    log_stream_prefix: str
+    """
+    paginator = log_client.get_paginator('describe_log_streams')
+    for page in paginator.paginate(logGroupName=log_group_name, logStreamNamePrefix=log_stream_prefix):
+        for log_stream in page['logStreams']:
+            yield log_stream['logStreamName']
+
+def read_log_stream(log_client, log_group_name, log_stream_name, start_time):
+    """
+    Yield the events of one stream from the oldest.
+
+    Parameters
+    log_client: boto3 logs client
+    log_group_name: str
+    log_stream_name: str
+    start_time: int milliseconds since EPOCH
+    """
+    request = {
+        'logGroupName': log_group_name,
+        'logStreamName': log_stream_name,
+        'startTime': start_time,
+        'startFromHead': True
+    }
+    while True:
+        response = log_client.get_log_events(**request)
+        for log_event in response['events']:
+            log_event['logStreamName'] = log_stream_name
+            yield log_event
+
+        # The same token is returned once the end of the stream is reached
+        if response['nextForwardToken'] == request.get('nextToken'):
+            return
+        request['nextToken'] = response['nextForwardToken']
+
+if __name__ == '__main__':
+    main()
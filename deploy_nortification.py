@@ -11,39 +11,106 @@ Change Detail: Change python version from 2.7 to 3.7 and local variables to envi
 
 import json
 import os
+import random
 import time
 
-from botocore.vendored import requests
-import boto3
+from lambda_common import (
+    claim_event, custom_print, emit_metric, flush_log, get_client, post_chatwork, release_event,
+    set_log_projections, start_chat, start_log
+)
+# Handler of the Chatwork outbox function, lambda_function.outbox_handler
+from lambda_common import outbox_handler
+
+# Fields of a payload written to the custom log, keyed by a top level key of the payload
+LOG_PROJECTIONS = {
+    'CodePipeline.job': [
+        ('CodePipeline.job', 'id'),
+        ('CodePipeline.job', 'data', 'actionConfiguration', 'configuration', 'FunctionName'),
+        ('CodePipeline.job', 'data', 'actionConfiguration', 'configuration', 'UserParameters'),
+        ('CodePipeline.job', 'data', 'continuationToken')
+    ]
+}
+set_log_projections(LOG_PROJECTIONS)
+
+# CodeDeploy wait: seconds before timing out, and seconds kept to report before the function times out
+DEPLOY_TIMEOUT = 240
+DEPLOY_SAFETY_MARGIN = 30
+
+# Polling profile of deployment groups not in DEPLOY_PROFILES, in seconds
+DEPLOY_DEFAULT_PROFILE = {'expected': 60, 'min_interval': 2, 'max_interval': 15}
+
+# Time until which this invocation may wait on CodeDeploy
+deploy_deadline = None
+
+# Enviornments reported by check_deployment and the variable of their deployment group
+# when DEPLOY_GROUPS is not configured
+DEPLOY_ENV_LABELS = {'Dev': '開発環境', 'Prod': '本番環境'}
+DEPLOY_GROUP_VARIABLES = {'Dev': 'GROUP_DEV', 'Prod': 'GROUP_PROD'}
+
+# Deployment statuses that end polling, and deployments per batch_get_deployments call
+DEPLOY_DONE_STATUSES = ('Succeeded', 'Failed', 'Stopped')
+BATCH_GET_DEPLOYMENTS_MAX = 25
+
+# States of the CodeDeploy state-change events that finish a deployment
+DEPLOY_EVENT_DONE_STATES = ('SUCCESS', 'FAILURE', 'STOP')
+
+# Jobs waiting on deployments: lifetime of a record in seconds,
+# and the records kept in this container when CORRELATION_TABLE is not configured
+CORRELATION_TTL = 24 * 60 * 60
+correlation_local_store = {}
+
+# Pipeline declarations kept in this container and their lifetime in seconds
+PIPELINE_CACHE_TTL = 5 * 60
+pipeline_cache = {}
+
+# CloudWatch namespace of the stage and deployment durations
+DEPLOY_METRIC_NAMESPACE = 'DeployNortification'
 
 def lambda_handler(event, context):
     """
     lambda main
     """
-    custom_print('[START] Starting Script')
-    custom_print(event)
-
-    # Developers Env
-    url = os.environ['URL']
-    chatwork_token = os.environ['TOKEN']
-    chatwork_room = os.environ['ROOM']
-
-    chatwork_url = '{0}/rooms/{1}/messages'.format(url, chatwork_room)
-    headers = {'X-ChatWorkToken': chatwork_token}
-
-    # deploy nortification
-    found = 0
-    # deployment trigger
-    for key in event:
-        if key == 'CodePipeline.job':
-            found = 1
-
-    # if key is found, trigger is from CodePipeline
-    if found:
-        check_enviornment(chatwork_url, headers, event)
-
-    custom_print('[FINISH] Finished running script')
-    return 0
+    try:
+        start_log(context)
+        start_chat(context)
+        start_deploy(context)
+        custom_print('[START] Starting Script')
+        custom_print(event)
+
+        # Developers Env
+        url = os.environ['URL']
+        chatwork_token = os.environ['TOKEN']
+        chatwork_room = os.environ['ROOM']
+
+        chatwork_url = '{0}/rooms/{1}/messages'.format(url, chatwork_room)
+        headers = {'X-ChatWorkToken': chatwork_token}
+
+        # deploy nortification
+        found = 0
+        # deployment trigger
+        for key in event:
+            if key == 'CodePipeline.job':
+                found = 1
+
+        # Drop a delivery of a job that was already handled
+        event_key = get_event_key(event)
+        if not claim_event(event_key):
+            custom_print('[INFO] Duplicate delivery was dropped: ' + str(event_key))
+            return 0
+
+        # if key is found, trigger is from CodePipeline
+        if found:
+            try:
+                check_enviornment(chatwork_url, headers, event)
+            except Exception:
+                release_event(event_key)
+                raise
+
+        custom_print('[FINISH] Finished running script')
+        return 0
+    finally:
+        # Ship the custom log before the container is frozen
+        flush_log()
 
 def check_enviornment(chatwork_url, headers, event):
     """
@@ -57,110 +124,17 @@ def check_enviornment(chatwork_url, headers, event):
     """
     try:
         env = event['CodePipeline.job']['data']['actionConfiguration']['configuration']['UserParameters']
-        pipelineclient = boto3.client('codepipeline')
+        pipelineclient = get_client('codepipeline')
         job_id = event['CodePipeline.job']['id']
 
-        # For Developers enviornment
-        if env == 'Dev':
-            custom_print('[INFO] Retrieving CodeDeploy Status for ' + str(env) + ' enviornment')
-            cont = 1
-            total = 0
-
-            while cont:
-
-                web_response = get_codedeploy_details(os.environ['APP'], os.environ['GROUP_DEV'])
-                web_status = web_response['deploymentGroupInfo']['lastAttemptedDeployment']['status']
-                web_id = web_response['deploymentGroupInfo']['lastAttemptedDeployment']['deploymentId']
-
-                # If Deployment Successful, report as success
-                if web_status == 'Succeeded':
-                    custom_print('[INFO] Deployment was successful for ' + str(env) + ' enviornment')
-
-                    cont = 0
-
-                    # Send notification to Typetalk
-                    requests.post(chatwork_url, headers=headers, params={
-                        'body': '開発環境への反映が終わりました。問題ありませんでした。' +
-                        '\nBATCHサーバ: ' + web_status + ' ('+ web_id + ')'
-                        })
-
-                    # Tell CodePipeline success
-                    response = pipelineclient.put_job_success_result(jobId=job_id)
-                    custom_print('[INFO] Sent CodePipeline success result')
-
-                else:
-                    # Increase the timer
-                    time.sleep(15)
-                    total += 15
-
-                    #if more than 240 seconds then fail as timeout
-                    if total > 240:
-                        # Send notification to Typetalk
-                        requests.post(chatwork_url, headers=headers, params={
-                            'body': '開発環境への自動デプロイが失敗しました。' +
-                            '\nWEBサーバ: ' + web_status  + ' ('+ web_id + ')'
-                        })
-
-                        # Tell CodePipeline Fail
-                        response = pipelineclient.put_job_failure_result(jobId=job_id, failureDetails={
-                            'message': 'Deployment has failed because it took more than 4 minutes to finish', 'type': 'JobFailed'
-                        })
-                        custom_print('[WARNING] Sent CodePipeline fail result')
-                        return 1
-
-        # For Production Result
-        elif env == 'Prod':
-
-            custom_print('[INFO] Retrieving CodeDeploy Status for ' + str(env) + ' enviornment')
-            cont = 1
-            total = 0
-
-            while cont:
-
-                web_response = get_codedeploy_details(os.environ['APP'], os.environ['GROUP_PROD'])
-                web_status = web_response['deploymentGroupInfo']['lastAttemptedDeployment']['status']
-                web_id = web_response['deploymentGroupInfo']['lastAttemptedDeployment']['deploymentId']
-
-                # If Deployment Successful, report as success
-                if web_status == 'Succeeded':
-                    custom_print('[INFO] Deployment was successful for ' + str(env) + ' enviornment')
-
-                    cont = 0
-
-                    # Send notification to Typetalk
-                    requests.post(chatwork_url, headers=headers, params={
-                        'body': '本番環境への反映が終わりました。問題ありませんでした。' +
-                        '\nBATCHサーバ: ' + web_status + ' ('+ web_id + ')'
-                    })
-
-                    # Tell CodePipeline success
-                    response = pipelineclient.put_job_success_result(jobId=job_id)
-                    custom_print('[INFO] Sent CodePipeline success result')
-
-                else:
-                    # Increase the timer
-                    time.sleep(15)
-                    total += 15
-
-                    #if more than 240 seconds then fail as timeout
-                    if total > 240:
-                        # Send notification to Typetalk
-                        requests.post(chatwork_url, headers=headers, params={
-                            'body': '本番環境への自動デプロイが失敗しました。' +
-                            '\nWEBサーバ: ' + web_status  + ' ('+ web_id + ')'
-                        })
-
-                        # Tell CodePipeline Fail
-                        response = pipelineclient.put_job_failure_result(jobId=job_id, failureDetails={
-                            'message': 'Deployment has failed because it took more than 4 minutes to finish', 'type': 'JobFailed'
-                        })
-                        custom_print('[WARNING] Sent CodePipeline fail result')
-                        return 1
+        # For Developers and Production Result
+        if is_deploy_enviornment(env):
+            return check_deployment(chatwork_url, headers, event, env)
 
         # For Production Trigger
         elif env == 'PROD_START':
-            response = pipelineclient.get_pipeline_state(name=os.environ['PIPELINE'])
-            approval_stage = response['stageStates'][3]['actionStates'][0]['latestExecution']
+            pipeline_name = get_pipeline_context(job_id)['pipelineName']
+            approval_stage = get_approval_execution(pipeline_name)
 
             user = approval_stage['lastUpdatedBy']
             user = user.split(":")
@@ -168,24 +142,621 @@ def check_enviornment(chatwork_url, headers, event):
             summary = approval_stage['summary']
 
             custom_print('[INFO] ' + str(user[5]) + ' has pushed to prod enviornment')
-            requests.post(chatwork_url, headers=headers, params={
-                'body': str(user[5]) + '　が本番環境への承認を行いました。:runner: :dash:' +
+            post_chatwork(chatwork_url, headers,
+                str(user[5]) + '　が本番環境への承認を行いました。:runner: :dash:' +
                 '\n\nメッセージ内容: ' + str(summary)
-            })
+            )
 
             response = pipelineclient.put_job_success_result(jobId=job_id)
             custom_print('[INFO] Sent CodePipeline success result')
 
     except Exception as error:
-        response = pipelineclient.put_job_failure_result(jobId=job_id, failureDetails={'message': error, 'type': 'JobFailed'})
+        response = pipelineclient.put_job_failure_result(jobId=job_id, failureDetails={'message': str(error), 'type': 'JobFailed'})
         custom_print('[INFO] Sent CodePipeline fail result\n' + str(error))
-        requests.post(chatwork_url, headers=headers, params={
-            'body': '自動デプロイが失敗しました。' +
+        post_chatwork(chatwork_url, headers,
+            '自動デプロイが失敗しました。' +
             '\n\nエラーメッセージ内容: ' + str(error)
-        })
+        )
         custom_print(response)
         return 1
 
+def check_deployment(chatwork_url, headers, event, env):
+    """
+    Wait for the CodeDeploy deployments of the enviornment and
+    report the result of every deployment group to Chatwork and CodePipeline.
+    The deployments started by this pipeline execution are polled together,
+    one batch_get_deployments call per check.
+    When DEPLOY_POLL_MODE is 'continuation' the deployments are checked once;
+    while they are still running the job is handed back to CodePipeline
+    with a continuation token carrying the deployment ids and start time,
+    and CodePipeline invokes this function again later.
+    When DEPLOY_POLL_MODE is 'event' the deployments are checked once
+    and the job is left running; deployment_event_handler reports it
+    when CodeDeploy sends the state-change events, and stale_deployment_handler
+    reports it when no event has done so DEPLOY_TIMEOUT seconds after the start.
+
+    Parameters
+    chatwork_url: str
+    headers: dict {TOKEN}
+    event: dict {codepipeline event}
+    env: str enviornment in DEPLOY_GROUPS, or Dev or Prod
+    """
+    pipelineclient = get_client('codepipeline')
+    job_id = event['CodePipeline.job']['id']
+    groups = get_deploy_groups(env)
+    poll_mode = os.environ.get('DEPLOY_POLL_MODE')
+
+    continuation = event['CodePipeline.job']['data'].get('continuationToken')
+    if continuation:
+        continuation = json.loads(continuation)
+        deployments = continuation['deployments']
+        started = continuation['started']
+        custom_print('[INFO] Continuing CodeDeploy Status for ' + str(env) + ' enviornment: ' + str(deployments))
+    else:
+        custom_print('[INFO] Retrieving CodeDeploy Status for ' + str(env) + ' enviornment')
+        deployments = get_deployment_ids(job_id, groups)
+        started = time.time()
+
+    # Register the job before the first check, so that an event arriving meanwhile finds it
+    if poll_mode == 'event':
+        save_correlation(deployments, {
+            'job_id': job_id, 'chatwork_url': chatwork_url, 'env': env,
+            'deployments': deployments, 'started': started
+        })
+
+    # Give up at the deployment timeout, or early enough to report before the function times out.
+    # In continuation and event mode check only once.
+    deadline = time.time() if poll_mode in ('continuation', 'event') else min(started + DEPLOY_TIMEOUT, deploy_deadline)
+
+    # Poll as fast as the quickest group needs, around the end of the slowest one
+    profiles = [get_deploy_profile(group['app'], group['group']) for group in groups]
+    profile = {
+        'expected': max(profile['expected'] for profile in profiles),
+        'min_interval': min(profile['min_interval'] for profile in profiles),
+        'max_interval': min(profile['max_interval'] for profile in profiles)
+    }
+
+    deployment_infos = poll_until(
+        lambda: get_deployment_infos(list(deployments.values())),
+        is_deployment_done, started, deadline, profile
+    )
+    elapsed = int(time.time() - started)
+
+    if not is_deployment_done(deployment_infos):
+        # Still running: let CodePipeline invoke again instead of waiting here
+        if poll_mode == 'continuation' and elapsed < DEPLOY_TIMEOUT:
+            pipelineclient.put_job_success_result(
+                jobId=job_id,
+                continuationToken=json.dumps({'deployments': deployments, 'started': started})
+            )
+            custom_print('[INFO] Deployment is running after ' + str(elapsed) + ' seconds, continues in the next invocation')
+            return 0
+
+        # Still running: deployment_event_handler reports it
+        if poll_mode == 'event':
+            custom_print('[INFO] Deployment is running, waiting for the CodeDeploy events')
+            return 0
+
+    # Only one of this function and deployment_event_handler reports the job
+    if poll_mode == 'event' and not claim_event('deployment:' + job_id):
+        custom_print('[INFO] Deployment was already reported by the event handler')
+        return 0
+
+    return report_deployment(chatwork_url, headers, job_id, env, deployments, deployment_infos, started)
+
+def deployment_event_handler(event, context):
+    """
+    lambda main of the CodeDeploy state-change events.
+    Finds the CodePipeline job waiting on the deployment in the correlation store
+    and reports it once every deployment of the job has finished.
+    """
+    try:
+        start_log(context)
+        start_chat(context)
+        custom_print('[START] Starting Deployment Event')
+
+        deployment_id = event['detail']['deploymentId']
+        state = event['detail']['state']
+        custom_print('[INFO] Deployment ' + deployment_id + ' is ' + state)
+        if state not in DEPLOY_EVENT_DONE_STATES:
+            return 0
+
+        correlation = load_correlation(deployment_id)
+        if correlation is None:
+            custom_print('[INFO] No CodePipeline job is waiting on ' + deployment_id)
+            return 0
+
+        # The other deployments of the job may still be running
+        deployments = correlation['deployments']
+        deployment_infos = get_deployment_infos(list(deployments.values()))
+        if not is_deployment_done(deployment_infos):
+            custom_print('[INFO] Other deployments of the job are still running')
+            return 0
+
+        event_key = 'deployment:' + correlation['job_id']
+        if not claim_event(event_key):
+            custom_print('[INFO] Duplicate delivery was dropped: ' + event_key)
+            return 0
+
+        try:
+            headers = {'X-ChatWorkToken': os.environ['TOKEN']}
+            report_deployment(
+                correlation['chatwork_url'], headers, correlation['job_id'], correlation['env'],
+                deployments, deployment_infos, correlation['started']
+            )
+        except Exception:
+            release_event(event_key)
+            raise
+
+        custom_print('[FINISH] Finished running script')
+        return 0
+    finally:
+        # Ship the custom log before the container is frozen
+        flush_log()
+
+def stale_deployment_handler(event, context):
+    """
+    lambda main of the scheduled re-check of the jobs left running in event mode.
+    A job still waiting DEPLOY_TIMEOUT seconds after its start has lost
+    its state-change events or is stuck, so it is reported here:
+    as a failure when its deployments are still running.
+    """
+    try:
+        start_log(context)
+        start_chat(context)
+        custom_print('[START] Starting Stale Deployment Check')
+
+        headers = {'X-ChatWorkToken': os.environ['TOKEN']}
+        reported = 0
+        for correlation in list_stale_correlations():
+            # Jobs already reported by check_deployment or deployment_event_handler are skipped
+            event_key = 'deployment:' + correlation['job_id']
+            if not claim_event(event_key):
+                continue
+
+            try:
+                deployments = correlation['deployments']
+                report_deployment(
+                    correlation['chatwork_url'], headers, correlation['job_id'], correlation['env'],
+                    deployments, get_deployment_infos(list(deployments.values())), correlation['started']
+                )
+                reported += 1
+            except Exception as error:
+                release_event(event_key)
+                custom_print('[ERROR] Job ' + correlation['job_id'] + ': ' + str(error))
+
+        custom_print('[INFO] Reported ' + str(reported) + ' stale jobs')
+        custom_print('[FINISH] Finished running script')
+        return 0
+    finally:
+        # Ship the custom log before the container is frozen
+        flush_log()
+
+def report_deployment(chatwork_url, headers, job_id, env, deployments, deployment_infos, started):
+    """
+    Report the deployments of the job to Chatwork and CodePipeline:
+    success when every deployment succeeded, failure otherwise.
+
+    Parameters
+    chatwork_url: str
+    headers: dict {TOKEN}
+    job_id: str CodePipeline job id
+    env: str
+    deployments: dict {app/group: deployment id}
+    deployment_infos: dict {deployment id: deploymentInfo}
+    started: float EPOCH seconds the deployment started
+    """
+    pipelineclient = get_client('codepipeline')
+    label = DEPLOY_ENV_LABELS.get(env, env)
+    elapsed = int(time.time() - started)
+    statuses = [info['status'] for info in deployment_infos.values()]
+
+    report = format_deployments(deployments, deployment_infos)
+    custom_print('[INFO] Deployments of ' + str(env) + ' enviornment:\n' + report)
+
+    timings = record_pipeline_timings(job_id, deployments, deployment_infos)
+    if timings:
+        report += '\n所要時間: ' + timings
+
+    # If Deployment Successful, report as success
+    if statuses and all(status == 'Succeeded' for status in statuses):
+        custom_print('[INFO] Deployment was successful for ' + str(env) + ' enviornment after ' + str(elapsed) + ' seconds')
+
+        # Send notification to Typetalk
+        post_chatwork(chatwork_url, headers,
+            label + 'への反映が終わりました。問題ありませんでした。\n' + report
+        )
+
+        # Tell CodePipeline success
+        pipelineclient.put_job_success_result(jobId=job_id)
+        custom_print('[INFO] Sent CodePipeline success result')
+        return 0
+
+    # Failed, timed out, or the function is about to time out
+    post_chatwork(chatwork_url, headers,
+        label + 'への自動デプロイが失敗しました。\n' + report
+    )
+
+    # Tell CodePipeline Fail
+    if is_deployment_done(deployment_infos):
+        message = 'Deployment has failed: ' + report.replace('\n', ', ')
+    elif elapsed >= DEPLOY_TIMEOUT:
+        message = 'Deployment has failed because it took more than ' + str(DEPLOY_TIMEOUT) + ' seconds to finish'
+    else:
+        message = 'Deployment was still running after ' + str(elapsed) + ' seconds when the function ran out of time'
+    pipelineclient.put_job_failure_result(jobId=job_id, failureDetails={
+        'message': message, 'type': 'JobFailed'
+    })
+    custom_print('[WARNING] Sent CodePipeline fail result: ' + message)
+    return 1
+
+def is_deployment_done(deployment_infos):
+    """
+    True when every deployment has finished.
+
+    Parameters
+    deployment_infos: dict {deployment id: deploymentInfo}
+    """
+    return all(info['status'] in DEPLOY_DONE_STATUSES for info in deployment_infos.values())
+
+def save_correlation(deployments, correlation):
+    """
+    Remember which CodePipeline job waits on the deployments.
+    Each deployment id is written to CORRELATION_TABLE with the job record,
+    without a table a dict of this container stands in (local runs and tests).
+
+    Parameters
+    deployments: dict {app/group: deployment id}
+    correlation: dict {job_id, chatwork_url, env, deployments, started}
+    """
+    expires_at = int(time.time()) + CORRELATION_TTL
+    table_name = os.environ.get('CORRELATION_TABLE')
+    for deployment_id in deployments.values():
+        if table_name:
+            get_client('dynamodb').put_item(
+                TableName=table_name,
+                Item={
+                    'deployment_id': {'S': deployment_id},
+                    'correlation': {'S': json.dumps(correlation)},
+                    'expires_at': {'N': str(expires_at)}
+                }
+            )
+        else:
+            correlation_local_store[deployment_id] = (correlation, expires_at)
+
+    custom_print('[INFO] Job ' + correlation['job_id'] + ' waits on ' + str(list(deployments.values())))
+
+def load_correlation(deployment_id):
+    """
+    The job record saved by save_correlation, None when no job waits on the deployment.
+
+    Parameters
+    deployment_id: str
+    """
+    now = int(time.time())
+    table_name = os.environ.get('CORRELATION_TABLE')
+    if table_name:
+        response = get_client('dynamodb').get_item(
+            TableName=table_name,
+            Key={'deployment_id': {'S': deployment_id}},
+            ConsistentRead=True
+        )
+        item = response.get('Item')
+        if item is None or int(item['expires_at']['N']) <= now:
+            return None
+        return json.loads(item['correlation']['S'])
+
+    correlation, expires_at = correlation_local_store.get(deployment_id, (None, 0))
+    return correlation if expires_at > now else None
+
+def list_stale_correlations():
+    """
+    Job records of the correlation store started DEPLOY_TIMEOUT seconds ago or more,
+    one per job.
+    """
+    now = time.time()
+    table_name = os.environ.get('CORRELATION_TABLE')
+    if table_name:
+        records = []
+        paginator = get_client('dynamodb').get_paginator('scan')
+        for page in paginator.paginate(TableName=table_name, ProjectionExpression='correlation, expires_at'):
+            for item in page['Items']:
+                records.append((json.loads(item['correlation']['S']), int(item['expires_at']['N'])))
+    else:
+        records = list(correlation_local_store.values())
+
+    # Every deployment of a job has a record of the same job
+    stale = {}
+    for correlation, expires_at in records:
+        if expires_at > now and now - correlation['started'] >= DEPLOY_TIMEOUT:
+            stale[correlation['job_id']] = correlation
+    return list(stale.values())
+
+def get_deploy_groups(env):
+    """
+    Deployment groups of the enviornment.
+    DEPLOY_GROUPS is a JSON object of enviornment to a list of
+    {"app": codedeploy application name, "group": deployment group name}.
+    Without it the single group APP and GROUP_DEV or GROUP_PROD is used.
+
+    Parameters
+    env: str
+    """
+    deploy_groups = json.loads(os.environ.get('DEPLOY_GROUPS') or '{}')
+    if deploy_groups:
+        return deploy_groups[env]
+
+    return [{'app': os.environ['APP'], 'group': os.environ[DEPLOY_GROUP_VARIABLES[env]]}]
+
+def is_deploy_enviornment(env):
+    """
+    True when check_enviornment should wait for the deployments of env.
+
+    Parameters
+    env: str
+    """
+    deploy_groups = json.loads(os.environ.get('DEPLOY_GROUPS') or '{}')
+    return env in (deploy_groups or DEPLOY_ENV_LABELS)
+
+def get_deployment_ids(job_id, groups):
+    """
+    Deployment id of each group, as started by the pipeline execution of the job.
+    The CodeDeploy actions of the execution are looked up with
+    list_action_executions; a group without one falls back to
+    its lastAttemptedDeployment.
+    Groups are keyed by "app/group", as two apps may use the same group name.
+
+    Parameters
+    job_id: str CodePipeline job id
+    groups: list [{app, group}]
+    """
+    deployments = {}
+    try:
+        for action in list_pipeline_actions(get_pipeline_context(job_id)):
+            if action['input']['actionTypeId']['provider'] != 'CodeDeploy':
+                continue
+            external_id = action.get('output', {}).get('executionResult', {}).get('externalExecutionId')
+            configuration = action['input']['configuration']
+            key = configuration.get('ApplicationName', '') + '/' + configuration.get('DeploymentGroupName', '')
+            if external_id and key not in deployments:
+                deployments[key] = external_id
+
+    except Exception as error:
+        custom_print('[WARNING] Could not resolve the deployments of the pipeline execution: ' + str(error))
+
+    resolved = {}
+    for group in groups:
+        key = group['app'] + '/' + group['group']
+        if key in deployments:
+            resolved[key] = deployments[key]
+        else:
+            custom_print('[WARNING] No deployment in the pipeline execution for ' + key + ', using the last attempted one')
+            web_response = get_codedeploy_details(group['app'], group['group'])
+            resolved[key] = web_response['deploymentGroupInfo']['lastAttemptedDeployment']['deploymentId']
+
+    return resolved
+
+def get_pipeline_context(job_id):
+    """
+    Pipeline name, stage, action and execution id of the job.
+
+    Parameters
+    job_id: str CodePipeline job id
+    """
+    response = get_client('codepipeline').get_job_details(jobId=job_id)
+    return response['jobDetails']['data']['pipelineContext']
+
+def list_pipeline_actions(pipeline_context):
+    """
+    Yield the action executions of the pipeline execution, newest first.
+
+    Parameters
+    pipeline_context: dict {pipelineName, pipelineExecutionId}
+    """
+    paginator = get_client('codepipeline').get_paginator('list_action_executions')
+    pages = paginator.paginate(
+        pipelineName=pipeline_context['pipelineName'],
+        filter={'pipelineExecutionId': pipeline_context['pipelineExecutionId']}
+    )
+    for page in pages:
+        for action in page['actionExecutionDetails']:
+            yield action
+
+def get_pipeline_structure(pipeline_name, version=None):
+    """
+    Declaration of the pipeline, kept in the container for PIPELINE_CACHE_TTL
+    seconds or until the pipeline version changes.
+
+    Parameters
+    pipeline_name: str
+    version: int pipelineVersion of the current state, None accepts any
+    """
+    now = time.time()
+    cached = pipeline_cache.get(pipeline_name)
+    if cached and cached[1] > now and version in (None, cached[0]['version']):
+        return cached[0]
+
+    structure = get_client('codepipeline').get_pipeline(name=pipeline_name)['pipeline']
+    pipeline_cache[pipeline_name] = (structure, now + PIPELINE_CACHE_TTL)
+    return structure
+
+def get_approval_execution(pipeline_name):
+    """
+    Latest execution of the manual approval action of the pipeline.
+    The stage is APPROVAL_STAGE, or the first stage with an approval action,
+    looked up by name rather than by position.
+
+    Parameters
+    pipeline_name: str
+    """
+    state = get_client('codepipeline').get_pipeline_state(name=pipeline_name)
+    structure = get_pipeline_structure(pipeline_name, state.get('pipelineVersion'))
+    approval_stage = os.environ.get('APPROVAL_STAGE')
+
+    for stage in structure['stages']:
+        if approval_stage and stage['name'] != approval_stage:
+            continue
+        for action in stage['actions']:
+            if action['actionTypeId']['category'] != 'Approval':
+                continue
+            for stage_state in state['stageStates']:
+                if stage_state['stageName'] != stage['name']:
+                    continue
+                for action_state in stage_state['actionStates']:
+                    if action_state['actionName'] == action['name']:
+                        return action_state['latestExecution']
+
+    raise ValueError('No approval action found in pipeline ' + pipeline_name)
+
+def record_pipeline_timings(job_id, deployments, deployment_infos):
+    """
+    Emit the duration of every stage of the pipeline execution so far
+    and of every deployment group as CloudWatch Embedded Metric Format lines,
+    and return a short breakdown for the Chatwork message.
+    A stage lasts from its first action start to its last action update;
+    running actions, as this one, end now.
+
+    Parameters
+    job_id: str CodePipeline job id
+    deployments: dict {app/group: deployment id}
+    deployment_infos: dict {deployment id: deploymentInfo}
+    """
+    breakdown = []
+    try:
+        pipeline_context = get_pipeline_context(job_id)
+        pipeline_name = pipeline_context['pipelineName']
+
+        stage_times = {}
+        for action in list_pipeline_actions(pipeline_context):
+            started = action['startTime'].timestamp()
+            finished = time.time() if action['status'] == 'InProgress' else action['lastUpdateTime'].timestamp()
+            first, last = stage_times.get(action['stageName'], (started, finished))
+            stage_times[action['stageName']] = (min(first, started), max(last, finished))
+
+        namespace = os.environ.get('DEPLOY_METRIC_NAMESPACE', DEPLOY_METRIC_NAMESPACE)
+        for stage in get_pipeline_structure(pipeline_name)['stages']:
+            if stage['name'] not in stage_times:
+                continue
+            first, last = stage_times[stage['name']]
+            emit_metric(namespace, 'StageDuration', last - first, {'Pipeline': pipeline_name, 'Stage': stage['name']})
+            breakdown.append(stage['name'] + ' ' + str(int(last - first)) + '秒')
+
+        for group_key, deployment_id in deployments.items():
+            info = deployment_infos.get(deployment_id, {})
+            if 'createTime' in info and 'completeTime' in info:
+                emit_metric(namespace, 'DeploymentDuration', info['completeTime'].timestamp() - info['createTime'].timestamp(),
+                            {'Pipeline': pipeline_name, 'DeploymentGroup': group_key})
+
+    except Exception as error:
+        custom_print('[WARNING] Could not record the pipeline timings: ' + str(error))
+
+    return ' / '.join(breakdown)
+
+def get_deployment_infos(deployment_ids):
+    """
+    Status and times of the deployments, fetched BATCH_GET_DEPLOYMENTS_MAX at a time.
+
+    Parameters
+    deployment_ids: list [str]
+    """
+    codedeploy_client = get_client('codedeploy')
+    deployment_infos = {}
+    for index in range(0, len(deployment_ids), BATCH_GET_DEPLOYMENTS_MAX):
+        response = codedeploy_client.batch_get_deployments(
+            deploymentIds=deployment_ids[index:index + BATCH_GET_DEPLOYMENTS_MAX]
+        )
+        for info in response['deploymentsInfo']:
+            deployment_infos[info['deploymentId']] = info
+
+    return deployment_infos
+
+def format_deployments(deployments, deployment_infos):
+    """
+    One line per deployment group with its status and duration.
+
+    Parameters
+    deployments: dict {app/group: deployment id}
+    deployment_infos: dict {deployment id: deploymentInfo}
+    """
+    lines = []
+    for group_key, deployment_id in deployments.items():
+        info = deployment_infos.get(deployment_id, {})
+        line = group_key + ': ' + info.get('status', 'Unknown') + ' (' + deployment_id
+        if 'createTime' in info:
+            finished = info['completeTime'].timestamp() if 'completeTime' in info else time.time()
+            line += ', ' + str(int(finished - info['createTime'].timestamp())) + '秒'
+        lines.append(line + ')')
+
+    return '\n'.join(lines)
+
+def start_deploy(context):
+    """
+    Set the time the deployment must be reported by,
+    DEPLOY_SAFETY_MARGIN seconds before the function times out
+    to leave time for Chatwork and CodePipeline.
+    Without a context (local runs) DEPLOY_TIMEOUT bounds the wait.
+
+    Parameters
+    context: LambdaContext
+    """
+    global deploy_deadline
+    if context is not None:
+        deploy_deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - DEPLOY_SAFETY_MARGIN
+    else:
+        deploy_deadline = time.time() + DEPLOY_TIMEOUT
+
+def get_deploy_profile(app_name, group_name):
+    """
+    Polling profile of the deployment group.
+    DEPLOY_PROFILES is a JSON object of "app/group", or of a group name
+    shared by every app, to
+    {"expected": seconds, "min_interval": seconds, "max_interval": seconds},
+    missing keys and groups use DEPLOY_DEFAULT_PROFILE.
+
+    Parameters
+    app_name: str codedeploy application name
+    group_name: str codedeploy deploy group name
+    """
+    profile = dict(DEPLOY_DEFAULT_PROFILE)
+    profiles = json.loads(os.environ.get('DEPLOY_PROFILES') or '{}')
+    profile.update(profiles.get(app_name + '/' + group_name, profiles.get(group_name, {})))
+    return profile
+
+def poll_until(check, done, started, deadline, profile):
+    """
+    Call check until done accepts its result or the deadline passes,
+    and return the last result.
+    The first check is immediate, then the interval doubles with jitter
+    from min_interval up to max_interval. Around the expected duration
+    of the deployment the interval drops back to min_interval,
+    so a finished deployment is noticed within a few seconds.
+
+    Parameters
+    check: function() returning the current status
+    done: function(status) returning True when polling can stop
+    started: float EPOCH seconds the deployment started
+    deadline: float EPOCH seconds to stop polling at
+    profile: dict {expected, min_interval, max_interval}
+    """
+    interval = profile['min_interval']
+    attempts = 0
+    while True:
+        result = check()
+        attempts += 1
+        now = time.time()
+        if done(result) or now >= deadline:
+            custom_print('[INFO] Polled ' + str(attempts) + ' times, ' + str(int(now - started)) + ' seconds since the deployment started')
+            return result
+
+        # Poll fast while the deployment is expected to finish, back off otherwise
+        elapsed = now - started
+        if profile['expected'] * 0.8 <= elapsed + interval and elapsed <= profile['expected'] * 1.5:
+            interval = profile['min_interval']
+        else:
+            interval = min(interval * 2, profile['max_interval'])
+
+        time.sleep(max(0, min(interval * random.uniform(0.8, 1.2), deadline - now)))
+
 def get_codedeploy_details(app_name, group_name):
     """
     Retrieve CodeDeploy status.
@@ -195,80 +766,29 @@ def get_codedeploy_details(app_name, group_name):
     group_name: str codedeploy deploy group name
     """
     try:
-        codedeploy_client = boto3.client('codedeploy')
+        codedeploy_client = get_client('codedeploy')
 
         return codedeploy_client.get_deployment_group(
             applicationName=app_name,
-            deploymenGroupName=group_name
+            deploymentGroupName=group_name
         )
 
     except Exception as error:
         custom_print('[ERROR] ' + str(error))
         return 2
 
-def custom_print(msg):
+def get_event_key(event):
     """
-    AWS Lambda does not put logs in continous matter.
-    If you want to have a continous log, you need to create
-    your own log and put it inside that log.
-    Also, this will determine is the response is JSON
-    and print it in JSON format for easier read.
+    Key identifying an event across its deliveries: the CodePipeline job id.
 
     Parameters
-    msg: str
+    event: dict
     """
-    # If the message is a json format, print the result in json
-    # to make it easier to read.
-    if isinstance(msg, str):
-        msg = msg
-        print(msg)
-    else:
-        msgjson = json.dumps(msg, sort_keys=True, default=str)
-        msg = '[RESPONSE]\n' + msgjson
-        print('[RESPONSE] ' + msgjson)
-    # Time since EPOCH
-    time_stamp_milli = int(round(time.time() * 1000))
-
-    # Initialize
-    log_group_name = os.environ['CUSTOM_LOG_GROUP']
-    log_stream_name = os.environ['CUSTOM_LOG_STREAM']
-    region = os.environ['AWS_REGION']
-    log_client = boto3.client('logs', region_name=region)
-
-    # Obtain the response and check if token exists
-    log_response = log_client.describe_log_streams(
-        logGroupName=log_group_name,
-        logStreamNamePrefix=log_stream_name)['logStreams'][0]
-    found = 0
-    for key in log_response.keys():
-        if key == 'uploadSequenceToken':
-            found = 1
-
-    # If token does exists, the log already has entry; append to the log with token
-    if found:
-        upload_token = log_client.describe_log_streams(
-            logGroupName=log_group_name,
-            logStreamNamePrefix=log_stream_name)['logStreams'][0]['uploadSequenceToken']
-        response = log_client.put_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream_name,
-            logEvents=[
-                {
-                    'timestamp': time_stamp_milli,
-                    'message': msg
-                }
-            ],
-            sequenceToken=upload_token
-        )
-    # This log entry is absolutely new, therefore no need of token
-    else:
-        response = log_client.put_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream_name,
-            logEvents=[
-                {
-                    'timestamp': time_stamp_milli,
-                    'message': msg
-                }
-            ]
-        )
+    if 'CodePipeline.job' in event:
+        return 'codepipeline:' + str(event['CodePipeline.job']['id'])
+    return None
+
+# Build the clients during the init phase so it falls outside billed duration
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    for init_service in ('logs', 'codepipeline', 'codedeploy'):
+        get_client(init_service)
@@ -10,65 +10,504 @@ Change Detail: Change python version from 2.7 to 3.7 and local variables to envi
 """
 
 import json
+import math
 import os
+import random
 import time
+from datetime import datetime, timedelta
 
-import boto3
+from lambda_common import (
+    custom_print, describe_instance_statuses, describe_instances_by_id, emit_metric, flush_log,
+    format_instances, get_client, get_instance_ids, set_log_projections, start_log
+)
+
+# Fields of a payload written to the custom log, keyed by a top level key of the payload
+LOG_PROJECTIONS = {
+    'StartingInstances': [
+        ('StartingInstances', 'InstanceId'),
+        ('StartingInstances', 'PreviousState', 'Name'),
+        ('StartingInstances', 'CurrentState', 'Name')
+    ]
+}
+set_log_projections(LOG_PROJECTIONS)
+
+# EC2 API limit of instances per start call
+EC2_ACTION_BATCH_MAX = 50
+
+# Seconds before giving up on the instances, within one invocation and
+# across resumed invocations when EC2_RESUME_MODE is 'invoke' or 'return'
+EC2_WAIT_TIMEOUT = 200
+EC2_RESUME_TIMEOUT = 15 * 60
+
+# Readiness polling in seconds: when the status checks are expected to pass
+# and the shortest and longest interval between two checks
+EC2_READY_PROFILE = {'expected': 90, 'min_interval': 5, 'max_interval': 30}
+
+# Readiness polling of instances resumed from hibernation, which keep their memory
+EC2_RESUME_PROFILE = {'expected': 30, 'min_interval': 3, 'max_interval': 15}
+
+# StateReason code of an instance stopped by hibernation
+EC2_HIBERNATED_REASON = 'Client.UserInitiatedHibernate'
+
+# CloudWatch namespace of the time to ready
+EC2_METRIC_NAMESPACE = 'EC2Start'
+
+# Seconds kept to report before the function times out
+EC2_SAFETY_MARGIN = 15
+
+# States an instance being started never gets ready from,
+# and seconds after which a stopped one is taken as failed to start
+EC2_FAILED_STATES = ('shutting-down', 'terminated', 'stopping')
+EC2_START_GRACE = 30
+
+# Time until which this invocation may wait, and the function to resume in
+ec2_deadline = None
+ec2_function_arn = None
+
+# Times to ready kept per instance, and the history kept in this container
+# when BOOT_HISTORY_TABLE is not configured
+BOOT_HISTORY_SIZE = 20
+boot_history_local_store = {}
+
+# Pre-warm planning in seconds: lead of an instance without history,
+# margin added to the percentile, and how long after the target schedule_handler plans again
+PREWARM_DEFAULT_LEAD = 300
+PREWARM_MARGIN = 60
+PREWARM_REPLAN_DELAY = 60 * 60
 
 def lambda_handler(event, context):
     """
     lambda main
     """
-    custom_print('[START] Starting Script')
-
-    instance_id = os.environ['INSTANCE_ID']
+    try:
+        start_log(context)
+        start_ec2(context)
+        custom_print('[START] Starting Script')
 
-    # Start the instance
-    start_ec2_instances(instance_id)
-    custom_print('[FINISH] Finished running script')
+        # Start the instances, or keep waiting for the ones of a previous invocation.
+        # A pre-warm schedule names the instances to start.
+        result = start_ec2_instances(instance_ids=event.get('instance_ids'), resume=event.get('resume'))
+        custom_print('[FINISH] Finished running script')
 
-    return 0
+        # In 'return' mode the caller invokes again with this state
+        if isinstance(result, dict):
+            return result
+        return 0
+    finally:
+        # Ship the custom log before the container is frozen
+        flush_log()
 
-def start_ec2_instances(instance_id):
+def start_ec2_instances(instance_ids=None, resume=None):
     """
-    Start all instances and wait until they are started.
-    NOTE: the wait method can only wait for one instance at a time
-    This script is not expected to start multiple instances at once
-    therefore will not loop all instances to wait.
+    Start the instances and wait until their status checks pass.
+    The stopped instances are started EC2_ACTION_BATCH_MAX at a time and
+    all instances are checked together with one describe_instance_status
+    call per tick, often around the expected boot time and less otherwise.
+    Instances still stopping are started once they have stopped.
+    Instances resumed from hibernation are expected ready sooner than a boot.
+    An instance whose checks are impaired, that stops, or that cannot be
+    started is reported by SNS right away; the others are waited on until the deadline.
+    When the function is about to time out and EC2_RESUME_MODE is set,
+    the remaining wait is handed over: 'invoke' invokes this function
+    again asynchronously, 'return' returns {'resume': state} for
+    a state machine to invoke it again with.
+    A line per instance with its state, boot or resume, and time to ready is logged
+    and emitted as a metric, and sent by SNS when an instance is not ready in time.
+
+    Parameters
+    instance_ids: list [str] None selects them with get_instance_ids
+    resume: dict {instance_ids, waiting, stopping, ready, failed, started, requested, paths}
+        state of a previous invocation
     """
     try:
-        custom_print('[INFO] Starting Instance: ' + str(instance_id))
         region = os.environ['AWS_REGION']
-        ec2_client = boto3.client('ec2', region_name=region)
-        ec2_resource = boto3.resource('ec2').Instance(instance_id)
-
-        status_response = ec2_client.describe_instances(instance_ids=[instance_id])
+        ec2_client = get_client('ec2', region)
+        resume_mode = os.environ.get('EC2_RESUME_MODE')
 
-        if status_response['Reservations'][0]['Instances'][0]['State']['Name'] == "running":
-            custom_print('[INFO] Instance is already running: ' + str(instance_id))
+        if resume:
+            wait_state = resume
+            statuses = {}
+            custom_print('[INFO] Resuming the wait for Instances: ' + ', '.join(wait_state['waiting']))
         else:
-            custom_print('[INFO] Instance was not running so called to start: ' + str(instance_id))
-            response = ec2_client.start_instances(instance_ids=[instance_id])
-            custom_print(response)
-            ec2_resource.wait_until_running()
-            custom_print('[INFO] Waiting for Instance to be ready: ' + str(instance_id))
-            cont = 1
-            total = 0
-
-            while cont:
-                status_response = ec2_client.describe_instance_status(instance_ids=[instance_id])
-                if(status_response['InstanceStatuses'][0]['InstanceStatus']['Status'] == "ok" and status_response['InstanceStatuses'][0]['SystemStatus']['Status'] == "ok"):
-                    cont = 0
-                else:
-                    time.sleep(10)
-                    total += 10
-            custom_print('[INFO] Successfully Started Instance: ' + str(instance_id) + ' wait time was roughly: ' + str(total) + 'seconds.')
+            if instance_ids is None:
+                instance_ids = get_instance_ids()
+            custom_print('[INFO] Starting Instances: ' + ', '.join(instance_ids))
+            wait_state = {
+                'instance_ids': instance_ids, 'waiting': [], 'stopping': [], 'ready': {},
+                'failed': {}, 'started': time.time(), 'requested': {}, 'paths': {}
+            }
+
+            statuses = describe_instance_statuses(ec2_client, instance_ids)
+            to_start = []
+            unstartable = []
+            for instance_id in instance_ids:
+                state = statuses.get(instance_id, {}).get('state')
+                if state == 'stopped':
+                    to_start.append(instance_id)
+                elif state == 'stopping':
+                    wait_state['stopping'].append(instance_id)
+                elif state not in ('pending', 'running'):
+                    unstartable.append(instance_id)
+                    continue
+                wait_state['waiting'].append(instance_id)
+
+            custom_print('[INFO] Instances were not running so called to start: ' + ', '.join(to_start))
+            start_stopped_instances(ec2_client, to_start, wait_state)
+            if wait_state['stopping']:
+                custom_print('[INFO] Instances are still stopping, they are started once stopped: ' + ', '.join(wait_state['stopping']))
+            if unstartable:
+                fail_instances(unstartable, statuses, wait_state)
+            custom_print('[INFO] Waiting for Instances to be ready: ' + ', '.join(wait_state['waiting']))
+
+        instance_ids = wait_state['instance_ids']
+        started = wait_state['started']
+        ready = wait_state['ready']
+        paths = wait_state['paths']
+
+        # Stop at the overall timeout, or early enough to report before the function times out
+        timeout = EC2_RESUME_TIMEOUT if resume_mode in ('invoke', 'return') else EC2_WAIT_TIMEOUT
+        deadline = min(started + timeout, ec2_deadline)
+
+        # Every instance is checked with the same call, ready and failed ones drop out
+        profile = EC2_RESUME_PROFILE if paths and all(path == 'resume' for path in paths.values()) else EC2_READY_PROFILE
+        interval = profile['min_interval']
+        while wait_state['waiting']:
+            check_instances(ec2_client, wait_state, statuses)
+            now = time.time()
+            if not wait_state['waiting'] or now >= deadline:
+                break
+
+            # Poll fast while the instances are expected to get ready, back off otherwise
+            elapsed = now - started
+            if profile['expected'] * 0.8 <= elapsed + interval and elapsed <= profile['expected'] * 1.5:
+                interval = profile['min_interval']
+            else:
+                interval = min(interval * 2, profile['max_interval'])
+            time.sleep(max(0, min(interval * random.uniform(0.8, 1.2), deadline - now)))
+
+        # Hand the remaining wait over instead of timing out
+        waiting = wait_state['waiting']
+        if waiting and time.time() < started + timeout:
+            if resume_mode == 'invoke':
+                get_client('lambda').invoke(
+                    FunctionName=ec2_function_arn,
+                    InvocationType='Event',
+                    Payload=json.dumps({'resume': wait_state})
+                )
+                custom_print('[INFO] Instances are not ready yet, the wait continues in a new invocation: ' + ', '.join(waiting))
+                return 0
+            if resume_mode == 'return':
+                custom_print('[INFO] Instances are not ready yet, returning the wait to the caller: ' + ', '.join(waiting))
+                return {'resume': wait_state}
+
+        # Instances handled by a previous invocation were not described in this one
+        missing = [instance_id for instance_id in instance_ids if instance_id not in statuses]
+        if missing:
+            statuses.update(describe_instance_statuses(ec2_client, missing))
+        report = format_instances(instance_ids, statuses, ready, paths)
+        namespace = os.environ.get('EC2_METRIC_NAMESPACE', EC2_METRIC_NAMESPACE)
+        for instance_id, path in paths.items():
+            if instance_id in ready:
+                emit_metric(namespace, 'TimeToReady', ready[instance_id], {'InstanceId': instance_id, 'StartPath': path})
+                record_boot_history(instance_id, ready[instance_id], path)
+
+        if waiting:
+            message = 'Instances were not ready after ' + str(int(time.time() - started)) + ' seconds:\n' + report
+            custom_print('[ERROR] ' + message)
+            call_sns(message)
+            return 2
+
+        # Failed instances were already reported by fail_instances
+        if len(ready) < len(instance_ids):
+            custom_print('[ERROR] Some Instances failed to start:\n' + report)
+            return 2
+
+        custom_print('[INFO] Successfully Started Instances:\n' + report)
+        return 0
 
     except Exception as error:
         custom_print('[ERROR] ' + str(error))
         call_sns(str(error))
         return error
 
+def start_ec2(context):
+    """
+    Set the time the instances must be reported by,
+    EC2_SAFETY_MARGIN seconds before the function times out,
+    and the function to invoke when the wait is resumed.
+    Without a context (local runs) the overall timeout bounds the wait
+    and it is never handed over.
+
+    Parameters
+    context: LambdaContext
+    """
+    global ec2_deadline, ec2_function_arn
+    if context is not None:
+        ec2_deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - EC2_SAFETY_MARGIN
+        ec2_function_arn = context.invoked_function_arn
+    else:
+        ec2_deadline = time.time() + max(EC2_WAIT_TIMEOUT, EC2_RESUME_TIMEOUT)
+        ec2_function_arn = None
+
+def start_stopped_instances(ec2_client, instance_ids, wait_state):
+    """
+    Start stopped instances EC2_ACTION_BATCH_MAX at a time,
+    noting whether each resumes from hibernation and when it was started.
+
+    Parameters
+    ec2_client: boto3 ec2 client
+    instance_ids: list [str]
+    wait_state: dict paths and requested are updated in place
+    """
+    # Hibernated instances resume with their memory and get ready sooner
+    for instance_id, instance in describe_instances_by_id(ec2_client, instance_ids).items():
+        wait_state['paths'][instance_id] = get_start_path(instance)
+
+    for index in range(0, len(instance_ids), EC2_ACTION_BATCH_MAX):
+        response = ec2_client.start_instances(InstanceIds=instance_ids[index:index + EC2_ACTION_BATCH_MAX])
+        custom_print(response)
+
+    now = time.time()
+    for instance_id in instance_ids:
+        wait_state['requested'][instance_id] = now
+
+def get_start_path(instance):
+    """
+    How the instance starts: 'resume' when it was stopped by hibernation,
+    read from its StateReason, otherwise 'boot'.
+
+    Parameters
+    instance: dict describe_instances instance
+    """
+    hibernated = instance.get('StateReason', {}).get('Code') == EC2_HIBERNATED_REASON
+    return 'resume' if hibernated else 'boot'
+
+def check_instances(ec2_client, wait_state, statuses):
+    """
+    Check the waiting instances once and keep waiting on the ones not ready.
+    Ready instances are added to ready with the seconds since they were
+    started, not since the wait began; instances that were stopping
+    are started once stopped; instances whose status checks are
+    impaired or that stopped after their start are failed at once,
+    while the ones still initializing keep waiting.
+
+    Parameters
+    ec2_client: boto3 ec2 client
+    wait_state: dict {waiting, stopping, ready, failed, started, requested} updated in place
+    statuses: dict {instance id: {state, instance, system}} updated in place
+    """
+    statuses.update(describe_instance_statuses(ec2_client, wait_state['waiting']))
+    now = time.time()
+
+    still_waiting = []
+    newly_failed = []
+    now_stopped = []
+    for instance_id in wait_state['waiting']:
+        status = statuses.get(instance_id)
+        since_start = now - wait_state['requested'].get(instance_id, wait_state['started'])
+        if status is None:
+            # Not listed yet right after start_instances
+            still_waiting.append(instance_id)
+        elif instance_id in wait_state['stopping'] and status['state'] in ('stopping', 'stopped'):
+            if status['state'] == 'stopped':
+                now_stopped.append(instance_id)
+            still_waiting.append(instance_id)
+        elif status['state'] == 'running' and status['instance'] == 'ok' and status['system'] == 'ok':
+            wait_state['ready'][instance_id] = since_start
+        elif ('impaired' in (status['instance'], status['system']) or status['state'] in EC2_FAILED_STATES
+              or (status['state'] == 'stopped' and since_start > EC2_START_GRACE)):
+            newly_failed.append(instance_id)
+        else:
+            still_waiting.append(instance_id)
+    wait_state['waiting'] = still_waiting
+
+    if now_stopped:
+        custom_print('[INFO] Instances have stopped so called to start: ' + ', '.join(now_stopped))
+        wait_state['stopping'] = [instance_id for instance_id in wait_state['stopping'] if instance_id not in now_stopped]
+        start_stopped_instances(ec2_client, now_stopped, wait_state)
+
+    if newly_failed:
+        fail_instances(newly_failed, statuses, wait_state)
+
+def fail_instances(instance_ids, statuses, wait_state):
+    """
+    Stop waiting on the instances and report them by SNS.
+
+    Parameters
+    instance_ids: list [str]
+    statuses: dict {instance id: {state, instance, system}}
+    wait_state: dict waiting and failed are updated in place
+    """
+    elapsed = time.time() - wait_state['started']
+    for instance_id in instance_ids:
+        wait_state['failed'][instance_id] = elapsed
+    wait_state['waiting'] = [instance_id for instance_id in wait_state['waiting'] if instance_id not in instance_ids]
+
+    report = format_instances(instance_ids, statuses, {})
+    custom_print('[ERROR] Instances failed to start:\n' + report)
+    call_sns('Instances failed to start:\n' + report)
+
+def schedule_handler(event, context):
+    """
+    lambda main of the pre-warm scheduler.
+    First schedules itself again PREWARM_REPLAN_DELAY seconds after the coming
+    PREWARM_TARGET, once the new boot times are recorded, then plans a one-time
+    EventBridge Scheduler schedule per instance that starts it early enough
+    to be ready at the target. The daily schedule of the template starts the
+    chain and plans again should a one-time run be missed.
+    Errors are raised after the SNS so that Lambda retries the invocation.
+    """
+    try:
+        start_log(context)
+        custom_print('[START] Starting Scheduler')
+
+        # Re-arm before anything else can fail
+        now = datetime.utcnow()
+        replan_at = get_next_target(now, 0) + timedelta(seconds=PREWARM_REPLAN_DELAY)
+        put_schedule('ec2-prewarm-scheduler-' + replan_at.strftime('%Y%m%d%H%M'), replan_at, context.invoked_function_arn, {})
+        custom_print('[INFO] Next planning at ' + replan_at.isoformat())
+
+        instance_ids = get_instance_ids()
+        instances = describe_instances_by_id(get_client('ec2', os.environ['AWS_REGION']), instance_ids)
+        for instance_id in instance_ids:
+            lead = get_prewarm_lead(instance_id, get_start_path(instances.get(instance_id, {})))
+            target = get_next_target(now, lead)
+            start_at = target - timedelta(seconds=lead)
+
+            # Named after the target, so planning the same morning twice updates one schedule
+            put_schedule('ec2-prewarm-' + instance_id + '-' + target.strftime('%Y%m%d%H%M'), start_at,
+                         os.environ['PREWARM_START_FUNCTION_ARN'], {'instance_ids': [instance_id]})
+            custom_print('[INFO] ' + instance_id + ' starts at ' + start_at.isoformat() + ' to be ready at ' + target.isoformat()
+                         + ', ' + str(lead) + ' seconds ahead')
+
+        custom_print('[FINISH] Finished running script')
+        return 0
+
+    except Exception as error:
+        custom_print('[ERROR] ' + str(error))
+        call_sns(str(error))
+        raise
+    finally:
+        # Ship the custom log before the container is frozen
+        flush_log()
+
+def get_prewarm_lead(instance_id, path):
+    """
+    Seconds the instance must be started before it is needed:
+    the PREWARM_PERCENTILE of its recorded times to ready plus PREWARM_MARGIN.
+    Only the times of the path it will take are used, as a resume is much
+    faster than a boot. An instance not stopped yet is planned as a boot.
+
+    Parameters
+    instance_id: str
+    path: str 'boot' or 'resume' from get_start_path
+    """
+    durations = sorted(entry['seconds'] for entry in load_boot_history(instance_id) if entry['path'] == path)
+    if not durations:
+        return PREWARM_DEFAULT_LEAD
+
+    # Nearest rank percentile
+    percentile = float(os.environ.get('PREWARM_PERCENTILE', '90'))
+    rank = max(1, int(math.ceil(percentile / 100 * len(durations))))
+    return int(math.ceil(durations[rank - 1])) + PREWARM_MARGIN
+
+def get_next_target(now, lead):
+    """
+    Next PREWARM_TARGET, 'HH:MM' in UTC like the cron of this function,
+    that is still at least lead seconds away.
+
+    Parameters
+    now: datetime UTC
+    lead: int seconds
+    """
+    hour, minute = [int(part) for part in os.environ['PREWARM_TARGET'].split(':')]
+    target = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    while target - timedelta(seconds=lead) <= now:
+        target += timedelta(days=1)
+    return target
+
+def put_schedule(name, at, function_arn, payload):
+    """
+    Create or replace a one-time EventBridge Scheduler schedule
+    that invokes the function with the payload, deleted once it has run.
+    Names must be unique per run: the deletion after a run would
+    remove a schedule of the same name updated during that run.
+
+    Parameters
+    name: str schedule name
+    at: datetime UTC
+    function_arn: str
+    payload: dict
+    """
+    scheduler_client = get_client('scheduler')
+    schedule = {
+        'Name': name,
+        'ScheduleExpression': 'at(' + at.strftime('%Y-%m-%dT%H:%M:%S') + ')',
+        'ScheduleExpressionTimezone': 'UTC',
+        'FlexibleTimeWindow': {'Mode': 'OFF'},
+        'ActionAfterCompletion': 'DELETE',
+        'Target': {
+            'Arn': function_arn,
+            'RoleArn': os.environ['PREWARM_SCHEDULER_ROLE_ARN'],
+            'Input': json.dumps(payload)
+        }
+    }
+    try:
+        scheduler_client.update_schedule(**schedule)
+    except scheduler_client.exceptions.ResourceNotFoundException:
+        scheduler_client.create_schedule(**schedule)
+
+def record_boot_history(instance_id, seconds, path):
+    """
+    Add a time to ready to the history of the instance,
+    keeping the last BOOT_HISTORY_SIZE of them.
+
+    Parameters
+    instance_id: str
+    seconds: float
+    path: str boot or resume
+    """
+    try:
+        history = load_boot_history(instance_id)
+        history.append({'seconds': round(seconds, 1), 'path': path, 'at': int(time.time())})
+        history = history[-BOOT_HISTORY_SIZE:]
+
+        table_name = os.environ.get('BOOT_HISTORY_TABLE')
+        if table_name:
+            get_client('dynamodb').put_item(
+                TableName=table_name,
+                Item={
+                    'instance_id': {'S': instance_id},
+                    'history': {'S': json.dumps(history)}
+                }
+            )
+        else:
+            boot_history_local_store[instance_id] = history
+
+    except Exception as error:
+        custom_print('[WARNING] Could not record the boot time of ' + instance_id + ': ' + str(error))
+
+def load_boot_history(instance_id):
+    """
+    Recorded times to ready of the instance, oldest first.
+    They are kept in BOOT_HISTORY_TABLE, without a table a dict
+    of this container stands in (local runs and tests).
+
+    Parameters
+    instance_id: str
+    """
+    table_name = os.environ.get('BOOT_HISTORY_TABLE')
+    if not table_name:
+        return list(boot_history_local_store.get(instance_id, []))
+
+    response = get_client('dynamodb').get_item(
+        TableName=table_name,
+        Key={'instance_id': {'S': instance_id}},
+        ConsistentRead=True
+    )
+    if 'Item' not in response:
+        return []
+    return json.loads(response['Item']['history']['S'])
 
 def call_sns(msg):
     """
@@ -76,7 +515,7 @@ def call_sns(msg):
     """
     topic_arn = os.environ["TOPIC_ARN"]
     subject = os.environ["SUBJECT"]
-    client = boto3.client("sns")
+    client = get_client("sns")
     request = {
         'TopicArn': topic_arn,
         'Message': msg,
@@ -85,69 +524,7 @@ def call_sns(msg):
 
     response = client.publish(**request)
 
-def custom_print(msg):
-    """
-    AWS Lambda does not put logs in continous matter.
-    If you want to have a continous log, you need to create
-    your own log and put it inside that log.
-    Also, this will determine is the response is JSON
-    and print it in JSON format for easier read.
-
-    Parameters
-    msg: str
-    """
-    # If the message is a json format, print the result in json
-    # to make it easier to read.
-    if isinstance(msg, str):
-        msg = msg
-        print(msg)
-    else:
-        msgjson = json.dumps(msg, sort_keys=True, default=str)
-        msg = '[RESPONSE]\n' + msgjson
-        print('[RESPONSE] ' + msgjson)
-    # Time since EPOCH
-    time_stamp_milli = int(round(time.time() * 1000))
-
-    # Initialize
-    log_group_name = os.environ['CUSTOM_LOG_GROUP']
-    log_stream_name = os.environ['CUSTOM_LOG_STREAM']
-    region = os.environ['AWS_REGION']
-    log_client = boto3.client('logs', region_name=region)
-
-    # Obtain the response and check if token exists
-    log_response = log_client.describe_log_streams(
-        logGroupName=log_group_name,
-        logStreamNamePrefix=log_stream_name)['logStreams'][0]
-    found = 0
-    for key in log_response.keys():
-        if key == 'uploadSequenceToken':
-            found = 1
-
-    # If token does exists, the log already has entry; append to the log with token
-    if found:
-        upload_token = log_client.describe_log_streams(
-            logGroupName=log_group_name,
-            logStreamNamePrefix=log_stream_name)['logStreams'][0]['uploadSequenceToken']
-        response = log_client.put_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream_name,
-            logEvents=[
-                {
-                    'timestamp': time_stamp_milli,
-                    'message': msg
-                }
-            ],
-            sequenceToken=upload_token
-        )
-    # This log entry is absolutely new, therefore no need of token
-    else:
-        response = log_client.put_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream_name,
-            logEvents=[
-                {
-                    'timestamp': time_stamp_milli,
-                    'message': msg
-                }
-            ]
-        )
+# Build the clients during the init phase so it falls outside billed duration
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    for init_service in ('logs', 'ec2', 'sns'):
+        get_client(init_service)
@@ -10,56 +10,334 @@ cost efficient reasoning.
 Change Detail: Change python version from 2.7 to 3.7 and local variables to environment variables
 """
 
-import json
 import os
 import time
 
-import boto3
+from lambda_common import (
+    custom_print, describe_instance_statuses, describe_instances_by_id, emit_metric, flush_log,
+    format_instances, get_client, get_instance_ids, set_log_projections, start_log
+)
+
+# Fields of a payload written to the custom log, keyed by a top level key of the payload
+LOG_PROJECTIONS = {
+    'StoppingInstances': [
+        ('StoppingInstances', 'InstanceId'),
+        ('StoppingInstances', 'PreviousState', 'Name'),
+        ('StoppingInstances', 'CurrentState', 'Name')
+    ]
+}
+set_log_projections(LOG_PROJECTIONS)
+
+# EC2 API limit of instances per stop call
+EC2_ACTION_BATCH_MAX = 50
+
+# Seconds between two status checks, and before giving up on the instances
+EC2_POLL_INTERVAL = 5
+EC2_WAIT_TIMEOUT = 150
+
+# CloudWatch namespace of the time to stop
+EC2_METRIC_NAMESPACE = 'EC2Stop'
+
+# Idle detection: queries per get_metric_data call, metric period and trailing window in seconds
+METRIC_QUERY_MAX = 500
+IDLE_PERIOD = 5 * 60
+IDLE_WINDOW = 60 * 60
+
+# An instance is idle while every period of the window stays at or below these,
+# unless overridden by IDLE_CPU_PERCENT, IDLE_NETWORK_BYTES and IDLE_AGENT_THRESHOLD
+IDLE_CPU_PERCENT = 5.0
+IDLE_NETWORK_BYTES = 5 * 1024 * 1024
+IDLE_AGENT_THRESHOLD = 0.0
+
+# Instances left running by the idle stop: seconds after a start, e.g. by the
+# pre-warm of ec2_start, unless overridden by IDLE_START_GRACE,
+# and the tag that exempts an instance when set to 'true', unless overridden by IDLE_EXEMPT_TAG
+IDLE_START_GRACE = 3 * 60 * 60
+IDLE_EXEMPT_TAG = 'IdleStopExempt'
 
 def lambda_handler(event, context):
     """
     lambda main
     """
-    custom_print('[START] Starting Script')
+    try:
+        start_log(context)
+        custom_print('[START] Starting Script')
 
-    instance_id = os.environ['INSTANCE_ID']
+        # Stop the idle instances, or all of them on the fixed schedules
+        if event.get('mode') == 'idle':
+            stop_idle_instances()
+        else:
+            stop_ec2_instances()
 
-    # Stop the instance
-    stop_ec2_instances(instance_id)
+        custom_print('[FINISH] Finished running script')
 
-    custom_print('[FINISH] Finished running script')
+        return 0
+    finally:
+        # Ship the custom log before the container is frozen
+        flush_log()
 
-    return 0
+def stop_ec2_instances(instance_ids=None):
+    """
+    Stop the instances and wait until they are stopped.
+    The running instances are stopped EC2_ACTION_BATCH_MAX at a time,
+    hibernated when possible, and all instances are checked together
+    with one describe_instance_status call per tick. A line per instance
+    with its state, path and time to stop is logged, and sent by SNS
+    when an instance is not stopped in time.
 
-def stop_ec2_instances(instance_id):
+    Parameters
+    instance_ids: list [str] None selects them with get_instance_ids
     """
-    Stop all instances and wait until they are stopped.
-    NOTE: the wait method can only wait for one instance at a time
-    This script is not expected to stop multiple instances at once
-    therefore will not loop all instances to wait.
+    try:
+        if instance_ids is None:
+            instance_ids = get_instance_ids()
+        region = os.environ['AWS_REGION']
+        custom_print('[INFO] Stopping Instances: ' + ', '.join(instance_ids))
+        ec2_client = get_client('ec2', region)
+        started = time.time()
+
+        statuses = describe_instance_statuses(ec2_client, instance_ids)
+        to_stop = [instance_id for instance_id in instance_ids
+                   if statuses.get(instance_id, {}).get('state') in ('pending', 'running')]
+
+        paths = stop_instances(ec2_client, to_stop)
+
+        # Every instance is checked with the same call, stopped ones drop out
+        stopped = {}
+        waiting = list(instance_ids)
+        while waiting:
+            statuses.update(describe_instance_statuses(ec2_client, waiting))
+            elapsed = time.time() - started
+            for instance_id in waiting:
+                if statuses.get(instance_id, {}).get('state') == 'stopped':
+                    stopped[instance_id] = elapsed
+            waiting = [instance_id for instance_id in waiting if instance_id not in stopped]
+
+            if waiting and elapsed < EC2_WAIT_TIMEOUT:
+                time.sleep(EC2_POLL_INTERVAL)
+            else:
+                break
+
+        namespace = os.environ.get('EC2_METRIC_NAMESPACE', EC2_METRIC_NAMESPACE)
+        for instance_id, path in paths.items():
+            if instance_id in stopped:
+                emit_metric(namespace, 'TimeToStop', stopped[instance_id], {'InstanceId': instance_id, 'StopPath': path})
+
+        report = format_instances(instance_ids, statuses, stopped, paths)
+        if len(stopped) < len(instance_ids):
+            custom_print('[ERROR] Instances were not stopped:\n' + report)
+            call_sns('Instances were not stopped:\n' + report)
+            return 2
+
+        custom_print('[INFO] Successfully Stopped Instances:\n' + report)
+
+    except Exception as error:
+        custom_print('[ERROR] ' + str(error))
+        call_sns(str(error))
+        return 2
+
+def stop_idle_instances():
+    """
+    Stop the running instances that have been idle for the trailing
+    IDLE_WINDOW, through stop_ec2_instances.
+    Instances started within IDLE_START_GRACE or tagged as exempt are left running.
+    The metrics of the whole fleet are read together with get_metric_data,
+    up to METRIC_QUERY_MAX queries per call, so hundreds of instances
+    take a few calls instead of one per instance and metric.
     """
     try:
         region = os.environ['AWS_REGION']
-        custom_print('[INFO] Stopping Instance: ' + str(instance_id))
-        ec2_client = boto3.client('ec2', region_name=region)
-        ec2_resource = boto3.resource('ec2').Instance(instance_id)
-        response = ec2_client.stop_instances(instance_ids=[instance_id])
-        custom_print(response)
-        ec2_resource.wait_until_stopped()
-        custom_print('[INFO] Successfully Called to Stop Instance: ' + str(instance_id))
+        instance_ids = get_instance_ids()
+        statuses = describe_instance_statuses(get_client('ec2', region), instance_ids)
+        running = [instance_id for instance_id in instance_ids if statuses.get(instance_id, {}).get('state') == 'running']
+        running = skip_exempt_instances(get_client('ec2', region), running)
+        custom_print('[INFO] Checking idle Instances: ' + ', '.join(running))
+
+        idle = get_idle_instances(running)
+        if not idle:
+            custom_print('[INFO] No idle Instances')
+            return 0
+
+        custom_print('[INFO] Idle Instances: ' + ', '.join(idle))
+        return stop_ec2_instances(idle)
 
     except Exception as error:
         custom_print('[ERROR] ' + str(error))
         call_sns(str(error))
         return 2
 
+def skip_exempt_instances(ec2_client, instance_ids):
+    """
+    Instances the idle stop may act on: not started within IDLE_START_GRACE,
+    as LaunchTime is renewed by every start, and not tagged IDLE_EXEMPT_TAG 'true'.
+
+    Parameters
+    ec2_client: boto3 ec2 client
+    instance_ids: list [str]
+    """
+    grace = float(os.environ.get('IDLE_START_GRACE', IDLE_START_GRACE))
+    exempt_tag = os.environ.get('IDLE_EXEMPT_TAG', IDLE_EXEMPT_TAG)
+    instances = describe_instances_by_id(ec2_client, instance_ids)
+
+    candidates = []
+    skipped = []
+    for instance_id in instance_ids:
+        instance = instances.get(instance_id, {})
+        tags = dict((tag['Key'], tag['Value']) for tag in instance.get('Tags', []))
+        if tags.get(exempt_tag, '').lower() == 'true':
+            skipped.append(instance_id + ' (' + exempt_tag + ')')
+        elif 'LaunchTime' in instance and time.time() - instance['LaunchTime'].timestamp() < grace:
+            skipped.append(instance_id + ' (started ' + str(int(time.time() - instance['LaunchTime'].timestamp())) + ' seconds ago)')
+        else:
+            candidates.append(instance_id)
+
+    if skipped:
+        custom_print('[INFO] Exempt from the idle stop: ' + ', '.join(skipped))
+    return candidates
+
+def get_idle_instances(instance_ids):
+    """
+    Instances whose CPU, network in and out, and IDLE_AGENT_METRIC of the
+    CloudWatch agent when set, stayed at or below the idle thresholds
+    in every IDLE_PERIOD of the trailing IDLE_WINDOW.
+    An instance missing datapoints, e.g. started during the window, is not idle.
+    The agent metric must be published with the InstanceId dimension only.
+
+    Parameters
+    instance_ids: list [str]
+    """
+    thresholds = {
+        'cpu': float(os.environ.get('IDLE_CPU_PERCENT', IDLE_CPU_PERCENT)),
+        'netin': float(os.environ.get('IDLE_NETWORK_BYTES', IDLE_NETWORK_BYTES)),
+        'netout': float(os.environ.get('IDLE_NETWORK_BYTES', IDLE_NETWORK_BYTES)),
+        'agent': float(os.environ.get('IDLE_AGENT_THRESHOLD', IDLE_AGENT_THRESHOLD))
+    }
+    metrics = {
+        'cpu': ('AWS/EC2', 'CPUUtilization', 'Average'),
+        'netin': ('AWS/EC2', 'NetworkIn', 'Sum'),
+        'netout': ('AWS/EC2', 'NetworkOut', 'Sum')
+    }
+    if os.environ.get('IDLE_AGENT_METRIC'):
+        metrics['agent'] = (os.environ.get('IDLE_AGENT_NAMESPACE', 'CWAgent'), os.environ['IDLE_AGENT_METRIC'], 'Average')
+
+    # Query ids must start with a lower case letter: <metric>_<index of the instance>
+    queries = []
+    for index, instance_id in enumerate(instance_ids):
+        for key, (namespace, metric_name, stat) in metrics.items():
+            queries.append({
+                'Id': key + '_' + str(index),
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': namespace,
+                        'MetricName': metric_name,
+                        'Dimensions': [{'Name': 'InstanceId', 'Value': instance_id}]
+                    },
+                    'Period': IDLE_PERIOD,
+                    'Stat': stat
+                },
+                'ReturnData': True
+            })
+
+    end_time = int(time.time()) // IDLE_PERIOD * IDLE_PERIOD
+    values = get_metric_values(queries, end_time - IDLE_WINDOW, end_time)
+
+    # The latest period may not be published yet
+    expected = IDLE_WINDOW // IDLE_PERIOD - 1
+    idle = []
+    busy = []
+    for index, instance_id in enumerate(instance_ids):
+        reasons = []
+        for key in metrics:
+            datapoints = values.get(key + '_' + str(index), [])
+            if len(datapoints) < expected:
+                reasons.append(key + ' ' + str(len(datapoints)) + '/' + str(expected) + ' datapoints')
+            elif max(datapoints) > thresholds[key]:
+                reasons.append(key + ' ' + str(round(max(datapoints), 1)))
+        if reasons:
+            busy.append(instance_id + ' (' + ', '.join(reasons) + ')')
+        else:
+            idle.append(instance_id)
+
+    if busy:
+        custom_print('[INFO] Busy Instances: ' + ', '.join(busy))
+    return idle
+
+def get_metric_values(queries, start_time, end_time):
+    """
+    Datapoints of each query, METRIC_QUERY_MAX queries per get_metric_data
+    call and following NextToken until every datapoint is read.
+    Returns dict {query id: [values]}
+
+    Parameters
+    queries: list [MetricDataQuery]
+    start_time: int EPOCH seconds
+    end_time: int EPOCH seconds
+    """
+    paginator = get_client('cloudwatch').get_paginator('get_metric_data')
+    values = {}
+    for index in range(0, len(queries), METRIC_QUERY_MAX):
+        pages = paginator.paginate(
+            MetricDataQueries=queries[index:index + METRIC_QUERY_MAX],
+            StartTime=start_time,
+            EndTime=end_time
+        )
+        for page in pages:
+            for result in page['MetricDataResults']:
+                values.setdefault(result['Id'], []).extend(result['Values'])
+    return values
+
+def stop_instances(ec2_client, instance_ids):
+    """
+    Stop the instances EC2_ACTION_BATCH_MAX at a time.
+    When EC2_HIBERNATE is 'true' the instances configured for hibernation
+    are hibernated, so they resume with their memory; an instance EC2 refuses
+    to hibernate is stopped normally instead.
+    Returns dict {instance id: 'hibernate' or 'stop'}
+
+    Parameters
+    ec2_client: boto3 ec2 client
+    instance_ids: list [str]
+    """
+    hibernate = []
+    if os.environ.get('EC2_HIBERNATE') == 'true' and instance_ids:
+        instances = describe_instances_by_id(ec2_client, instance_ids)
+        hibernate = [instance_id for instance_id in instance_ids
+                     if instances.get(instance_id, {}).get('HibernationOptions', {}).get('Configured')]
+    normal = [instance_id for instance_id in instance_ids if instance_id not in hibernate]
+
+    paths = {}
+    for index in range(0, len(hibernate), EC2_ACTION_BATCH_MAX):
+        batch = hibernate[index:index + EC2_ACTION_BATCH_MAX]
+        try:
+            response = ec2_client.stop_instances(InstanceIds=batch, Hibernate=True)
+            custom_print(response)
+            paths.update((instance_id, 'hibernate') for instance_id in batch)
+        except Exception as error:
+            # One instance refusing, e.g. launched too recently, fails the whole batch
+            custom_print('[WARNING] Could not hibernate ' + ', '.join(batch) + ', retrying one by one: ' + str(error))
+            for instance_id in batch:
+                try:
+                    ec2_client.stop_instances(InstanceIds=[instance_id], Hibernate=True)
+                    paths[instance_id] = 'hibernate'
+                except Exception as instance_error:
+                    custom_print('[WARNING] Could not hibernate ' + instance_id + ', stopping it instead: ' + str(instance_error))
+                    normal.append(instance_id)
+
+    for index in range(0, len(normal), EC2_ACTION_BATCH_MAX):
+        batch = normal[index:index + EC2_ACTION_BATCH_MAX]
+        response = ec2_client.stop_instances(InstanceIds=batch)
+        custom_print(response)
+        paths.update((instance_id, 'stop') for instance_id in batch)
+
+    return paths
+
 def call_sns(msg):
     """
     Nortify via E-mail if Exception arised.
     """
     topic_arn = os.environ["TOPIC_ARN"]
     subject = os.environ["SUBJECT"]
-    client = boto3.client("sns")
+    client = get_client("sns")
     request = {
         'TopicArn': topic_arn,
         'Message': msg,
@@ -68,69 +346,7 @@ def call_sns(msg):
 
     response = client.publish(**request)
 
-def custom_print(msg):
-    """
-    AWS Lambda does not put logs in continous matter.
-    If you want to have a continous log, you need to create
-    your own log and put it inside that log.
-    Also, this will determine is the response is JSON
-    and print it in JSON format for easier read.
-
-    Parameters
-    msg: str
-    """
-    # If the message is a json format, print the result in json
-    # to make it easier to read.
-    if isinstance(msg, str):
-        msg = msg
-        print(msg)
-    else:
-        msgjson = json.dumps(msg, sort_keys=True, default=str)
-        msg = '[RESPONSE]\n' + msgjson
-        print('[RESPONSE] ' + msgjson)
-    # Time since EPOCH
-    time_stamp_milli = int(round(time.time() * 1000))
-
-    # Initialize
-    log_group_name = os.environ['CUSTOM_LOG_GROUP']
-    log_stream_name = os.environ['CUSTOM_LOG_STREAM']
-    region = os.environ['AWS_REGION']
-    log_client = boto3.client('logs', region_name=region)
-
-    # Obtain the response and check if token exists
-    log_response = log_client.describe_log_streams(
-        logGroupName=log_group_name,
-        logStreamNamePrefix=log_stream_name)['logStreams'][0]
-    found = 0
-    for key in log_response.keys():
-        if key == 'uploadSequenceToken':
-            found = 1
-
-    # If token does exists, the log already has entry; append to the log with token
-    if found:
-        upload_token = log_client.describe_log_streams(
-            logGroupName=log_group_name,
-            logStreamNamePrefix=log_stream_name)['logStreams'][0]['uploadSequenceToken']
-        response = log_client.put_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream_name,
-            logEvents=[
-                {
-                    'timestamp': time_stamp_milli,
-                    'message': msg
-                }
-            ],
-            sequenceToken=upload_token
-        )
-    # This log entry is absolutely new, therefore no need of token
-    else:
-        response = log_client.put_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream_name,
-            logEvents=[
-                {
-                    'timestamp': time_stamp_milli,
-                    'message': msg
-                }
-            ]
-        )
+# Build the clients during the init phase so it falls outside billed duration
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    for init_service in ('logs', 'ec2', 'sns', 'cloudwatch'):
+        get_client(init_service)
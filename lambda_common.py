@@ -0,0 +1,867 @@
+"""
+Shared by the Lambda functions of this repository, which are deployed
+from the same directory. Each function imports what it needs from here.
+"""
+
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+import boto3
+from botocore.config import Config
+import urllib3
+
+# Faster JSON backend for the custom log when it is bundled
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# CloudWatch Logs limits of a single put_log_events call
+LOG_BATCH_MAX_COUNT = 10000
+LOG_BATCH_MAX_BYTES = 1048576
+LOG_BATCH_MAX_SPAN = 24 * 60 * 60 * 1000
+LOG_EVENT_OVERHEAD = 26
+LOG_EVENT_MAX_BYTES = 262144 - LOG_EVENT_OVERHEAD
+
+# Logged payloads: longest string kept, byte budget and keys never written
+LOG_MAX_STRING = 1024
+LOG_MAX_PAYLOAD_BYTES = 16384
+LOG_SECRET_KEYS = (
+    'accesskeyid', 'secretaccesskey', 'sessiontoken', 'artifactcredentials',
+    'token', 'x-chatworktoken', 'password', 'authorization'
+)
+
+# Fields of a payload written to the custom log, keyed by a top level key of the payload,
+# registered by the function with set_log_projections
+LOG_PROJECTIONS = {}
+
+# Retries of put_log_events when the sequence token is rejected
+LOG_PUT_ATTEMPTS = 3
+
+# Seconds the background worker holds a message and flush_log waits for it
+LOG_FLUSH_INTERVAL = 1
+LOG_DRAIN_TIMEOUT = 10
+
+# EC2 API limit of instances per describe_instance_status call
+EC2_STATUS_BATCH_MAX = 100
+
+# boto3 clients built once per container, keyed by (service, region, config)
+AWS_CLIENT_CONFIG = Config(tcp_keepalive=True, max_pool_connections=10)
+aws_session = boto3.session.Session()
+aws_clients = {}
+aws_client_lock = threading.Lock()
+
+# Chatwork connection pool kept across warm invocations
+CHAT_TIMEOUT = urllib3.Timeout(connect=3.0, read=10.0)
+chat_http = urllib3.PoolManager(maxsize=4, timeout=CHAT_TIMEOUT, retries=False)
+
+# Chatwork allows 300 requests per 5 minutes for each token
+CHAT_RATE_PER_SECOND = 1.0
+CHAT_RATE_BURST = 10
+CHAT_MAX_ATTEMPTS = 5
+CHAT_BACKOFF_BASE = 1
+CHAT_BACKOFF_MAX = 30
+# Seconds kept free at the end of the invocation for the outbox and the custom log
+CHAT_DEADLINE_MARGIN = 15
+
+# Token bucket and the quota Chatwork reported, kept across warm invocations
+chat_bucket = {'tokens': CHAT_RATE_BURST, 'updated': time.time(), 'remaining': None, 'reset': 0}
+chat_lock = threading.Lock()
+
+# Time until which this invocation may wait on Chatwork
+chat_deadline = None
+
+# Events already handled: keys seen by this container and their lifetime in seconds
+IDEMPOTENCY_TTL = 24 * 60 * 60
+IDEMPOTENCY_MEMORY_MAX = 1024
+idempotency_memory = OrderedDict()
+idempotency_lock = threading.Lock()
+
+# Claimed keys kept in this container when IDEMPOTENCY_TABLE is not configured
+idempotency_local_store = {}
+
+# Messages of the current invocation waiting to be shipped
+log_buffer = []
+
+# Container id used to name the custom log stream shard of this container
+LOG_CONTAINER_ID = os.environ.get('AWS_LAMBDA_LOG_STREAM_NAME', '').split(']')[-1] or uuid.uuid4().hex
+
+# Sequence token of the custom log stream, kept across warm invocations
+log_stream_current = None
+log_sequence_token = None
+log_token_synced = False
+
+# Request id of the current invocation
+log_invocation_id = None
+
+# Background worker used when CUSTOM_LOG_ASYNC is 'true'
+log_queue = queue.Queue()
+log_worker = None
+log_worker_lock = threading.Lock()
+
+def get_client(service, region=None, config=None):
+    """
+    Return the boto3 client of the service, building it only once per container.
+    Warm invocations reuse the client, its loaded service model and
+    its keep-alive connection pool.
+
+    Parameters
+    service: str
+    region: str defaults to AWS_REGION
+    config: botocore.config.Config defaults to AWS_CLIENT_CONFIG,
+            a client of another config is built and kept separately
+    """
+    region = region or os.environ.get('AWS_REGION')
+    config = config or AWS_CLIENT_CONFIG
+    key = (service, region, id(config))
+
+    # boto3 sessions are not thread safe, the log worker may build one too
+    with aws_client_lock:
+        if key not in aws_clients:
+            aws_clients[key] = aws_session.client(service, region_name=region, config=config)
+        return aws_clients[key]
+
+def custom_print(msg):
+    """
+    AWS Lambda does not put logs in continous matter.
+    If you want to have a continous log, you need to create
+    your own log and put it inside that log.
+    Also, this will determine is the response is JSON
+    and print it in JSON format for easier read.
+    The message is only buffered or queued here; flush_log ships it.
+
+    Parameters
+    msg: str
+    """
+    # If the message is a json format, print the result in json
+    # to make it easier to read.
+    if isinstance(msg, str):
+        print(msg)
+    else:
+        msgjson = format_payload(msg)
+        msg = '[RESPONSE]\n' + msgjson
+        print('[RESPONSE] ' + msgjson)
+
+    # CloudWatch Logs rejects a single event larger than 256 KB
+    encoded = msg.encode('utf-8')
+    if len(encoded) > LOG_EVENT_MAX_BYTES:
+        msg = encoded[:LOG_EVENT_MAX_BYTES].decode('utf-8', 'ignore')
+
+    # Time since EPOCH
+    log_event = {
+        'timestamp': int(round(time.time() * 1000)),
+        'message': msg
+    }
+
+    # The background worker ships the message so the caller never waits on it
+    if os.environ.get('CUSTOM_LOG_ASYNC') == 'true':
+        start_log_worker()
+        log_queue.put(log_event)
+    else:
+        log_buffer.append(log_event)
+
+def format_payload(payload):
+    """
+    Serialize a payload for the custom log.
+    Only the fields configured in LOG_PROJECTIONS are kept,
+    secrets are masked, long strings are truncated and the result
+    is capped at LOG_MAX_PAYLOAD_BYTES.
+
+    Parameters
+    payload: dict event or API response
+    """
+    payload = mask_payload(project_payload(payload))
+
+    if orjson is not None:
+        payload_json = orjson.dumps(payload, default=str).decode('utf-8')
+    else:
+        payload_json = json.dumps(payload, default=str)
+
+    encoded = payload_json.encode('utf-8')
+    if len(encoded) > LOG_MAX_PAYLOAD_BYTES:
+        payload_json = encoded[:LOG_MAX_PAYLOAD_BYTES].decode('utf-8', 'ignore') + '...(' + str(len(encoded)) + ' bytes)'
+    return payload_json
+
+def set_log_projections(projections):
+    """
+    Register the fields kept by project_payload for the payloads of a function.
+    Called once by each function when it is loaded.
+
+    Parameters
+    projections: dict {top level key: [(key, ...)]}
+    """
+    LOG_PROJECTIONS.clear()
+    LOG_PROJECTIONS.update(projections)
+
+def project_payload(payload):
+    """
+    Keep only the fields configured for the payload type.
+    The type is found by the first LOG_PROJECTIONS key present in the payload.
+    Set CUSTOM_LOG_FULL_PAYLOAD to 'true' to log every field.
+
+    Parameters
+    payload: dict
+    """
+    if not isinstance(payload, dict) or os.environ.get('CUSTOM_LOG_FULL_PAYLOAD') == 'true':
+        return payload
+
+    for payload_type, paths in LOG_PROJECTIONS.items():
+        if payload_type in payload:
+            projected = {}
+            for path in paths:
+                value = pick_path(payload, path)
+                if value not in (None, []):
+                    projected['.'.join(path)] = value
+            return projected
+
+    return payload
+
+def pick_path(source, path):
+    """
+    Value at the path, or None if it does not exist.
+    A list on the way is followed into each of its items.
+
+    Parameters
+    source: dict
+    path: tuple (key, ...)
+    """
+    for index, key in enumerate(path):
+        if isinstance(source, list):
+            values = [pick_path(item, path[index:]) for item in source]
+            return [value for value in values if value is not None]
+        if not isinstance(source, dict) or key not in source:
+            return None
+        source = source[key]
+    return source
+
+def mask_payload(value):
+    """
+    Copy of the value with secrets masked and long strings truncated.
+
+    Parameters
+    value: any
+    """
+    if isinstance(value, dict):
+        masked = {}
+        for key, item in value.items():
+            if str(key).split('.')[-1].lower() in LOG_SECRET_KEYS:
+                masked[key] = '********'
+            else:
+                masked[key] = mask_payload(item)
+        return masked
+    if isinstance(value, (list, tuple)):
+        return [mask_payload(item) for item in value]
+    if isinstance(value, str) and len(value) > LOG_MAX_STRING:
+        return value[:LOG_MAX_STRING] + '...(' + str(len(value)) + ' chars)'
+    return value
+
+def flush_log():
+    """
+    Ship every buffered message to the custom log stream.
+    Must be called before the handler returns, otherwise the
+    messages of this invocation are lost when the container is frozen.
+    When the background worker is running, wait until it has drained
+    the queue instead, at most LOG_DRAIN_TIMEOUT seconds.
+    """
+    if log_worker is not None and log_worker.is_alive():
+        drained = threading.Event()
+        log_queue.put(drained)
+        if not drained.wait(LOG_DRAIN_TIMEOUT):
+            print('[WARNING] Custom log was not drained within ' + str(LOG_DRAIN_TIMEOUT) + ' seconds')
+        return
+
+    ship_log_buffer()
+
+def ship_log_buffer():
+    """
+    Put the buffered messages to the custom log stream in batches.
+    """
+    if not log_buffer:
+        return
+
+    events = sorted(log_buffer, key=lambda log_event: log_event['timestamp'])
+    del log_buffer[:]
+
+    try:
+        for batch in split_log_batches(events):
+            put_log_batch(batch)
+    except Exception as error:
+        # Never fail the handler because of the custom log
+        print('[ERROR] Failed to ship custom log: ' + str(error))
+
+def start_log_worker():
+    """
+    Start the background worker that ships the custom log
+    if it is not running in this container yet.
+    """
+    global log_worker
+
+    with log_worker_lock:
+        if log_worker is None or not log_worker.is_alive():
+            log_worker = threading.Thread(target=log_worker_loop, name='custom-log', daemon=True)
+            log_worker.start()
+
+def log_worker_loop():
+    """
+    Collect the queued messages and ship them when the oldest one has waited
+    LOG_FLUSH_INTERVAL seconds, the batch is full or flush_log asks for it.
+    In this mode the buffer is only touched by this thread.
+    """
+    while True:
+        try:
+            item = log_queue.get(timeout=LOG_FLUSH_INTERVAL)
+        except queue.Empty:
+            ship_log_buffer()
+            continue
+
+        # flush_log is waiting for the queue to be drained
+        if isinstance(item, threading.Event):
+            ship_log_buffer()
+            item.set()
+            continue
+
+        log_buffer.append(item)
+        waited = time.time() * 1000 - log_buffer[0]['timestamp']
+        if len(log_buffer) >= LOG_BATCH_MAX_COUNT or waited >= LOG_FLUSH_INTERVAL * 1000:
+            ship_log_buffer()
+
+def split_log_batches(events):
+    """
+    Split the events into batches within the put_log_events limits:
+    number of events, total byte size and 24 hours time span.
+
+    Parameters
+    events: list [{timestamp, message}] sorted by timestamp
+    """
+    batch = []
+    batch_size = 0
+    for log_event in events:
+        event_size = len(log_event['message'].encode('utf-8')) + LOG_EVENT_OVERHEAD
+        if batch and (len(batch) >= LOG_BATCH_MAX_COUNT
+                      or batch_size + event_size > LOG_BATCH_MAX_BYTES
+                      or log_event['timestamp'] - batch[0]['timestamp'] >= LOG_BATCH_MAX_SPAN):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(log_event)
+        batch_size += event_size
+    if batch:
+        yield batch
+
+def start_log(context):
+    """
+    Remember the invocation so the custom log stream can be
+    sharded per invocation when CUSTOM_LOG_STREAM_MODE is 'invocation'.
+
+    Parameters
+    context: LambdaContext
+    """
+    global log_invocation_id
+    log_invocation_id = getattr(context, 'aws_request_id', None) or uuid.uuid4().hex
+
+def get_log_stream_name():
+    """
+    Name of the custom log stream to write to.
+    single: CUSTOM_LOG_STREAM shared by every container (default)
+    container: CUSTOM_LOG_STREAM/<container id>
+    invocation: CUSTOM_LOG_STREAM/<container id>/<request id>
+    """
+    log_stream_prefix = os.environ['CUSTOM_LOG_STREAM']
+    mode = os.environ.get('CUSTOM_LOG_STREAM_MODE', 'single')
+
+    if mode == 'container':
+        return log_stream_prefix + '/' + LOG_CONTAINER_ID
+    if mode == 'invocation':
+        return log_stream_prefix + '/' + LOG_CONTAINER_ID + '/' + str(log_invocation_id)
+    return log_stream_prefix
+
+def put_log_batch(batch):
+    """
+    Put one batch of events to the custom log stream.
+    The sequence token returned by put_log_events is kept for the next call,
+    so the stream is only described again after the token was rejected.
+
+    Parameters
+    batch: list [{timestamp, message}]
+    """
+    global log_sequence_token, log_token_synced, log_stream_current
+
+    # Initialize
+    log_group_name = os.environ['CUSTOM_LOG_GROUP']
+    log_stream_name = get_log_stream_name()
+    region = os.environ['AWS_REGION']
+    log_client = get_client('logs', region)
+
+    # The token belongs to the stream; a new shard starts without one
+    if log_stream_name != log_stream_current:
+        log_stream_current = log_stream_name
+        log_token_synced = False
+
+    for attempt in range(LOG_PUT_ATTEMPTS):
+        if not log_token_synced:
+            sync_log_token(log_client, log_group_name, log_stream_name)
+
+        request = {
+            'logGroupName': log_group_name,
+            'logStreamName': log_stream_name,
+            'logEvents': batch
+        }
+        # This log entry is absolutely new, therefore no need of token
+        if log_sequence_token:
+            request['sequenceToken'] = log_sequence_token
+
+        try:
+            response = log_client.put_log_events(**request)
+            log_sequence_token = response.get('nextSequenceToken')
+            return response
+
+        # Another writer has used the token; retry with the expected one
+        except log_client.exceptions.InvalidSequenceTokenException as error:
+            expected_token = error.response.get('expectedSequenceToken')
+            if expected_token:
+                log_sequence_token = expected_token
+            else:
+                log_token_synced = False
+
+        # The batch was already stored by a previous attempt
+        except log_client.exceptions.DataAlreadyAcceptedException as error:
+            expected_token = error.response.get('expectedSequenceToken')
+            if expected_token:
+                log_sequence_token = expected_token
+            else:
+                log_token_synced = False
+            return None
+
+    raise RuntimeError('Sequence token was rejected ' + str(LOG_PUT_ATTEMPTS) + ' times for ' + log_stream_name)
+
+def sync_log_token(log_client, log_group_name, log_stream_name):
+    """
+    Read the upload sequence token of the custom log stream.
+    A sharded stream is created on its first use and starts without a token.
+
+    Parameters
+    log_client: boto3 logs client
+    log_group_name: str
+    log_stream_name: str
+    """
+    global log_sequence_token, log_token_synced
+
+    if log_stream_name != os.environ['CUSTOM_LOG_STREAM']:
+        try:
+            log_client.create_log_stream(
+                logGroupName=log_group_name,
+                logStreamName=log_stream_name)
+            log_sequence_token = None
+            log_token_synced = True
+            return
+        except log_client.exceptions.ResourceAlreadyExistsException:
+            pass
+
+    log_streams = log_client.describe_log_streams(
+        logGroupName=log_group_name,
+        logStreamNamePrefix=log_stream_name)['logStreams']
+
+    log_sequence_token = None
+    for log_stream in log_streams:
+        if log_stream['logStreamName'] == log_stream_name:
+            log_sequence_token = log_stream.get('uploadSequenceToken')
+    log_token_synced = True
+
+def outbox_handler(event, context):
+    """
+    lambda main of the Chatwork outbox.
+    Sends again the messages post_chatwork could not send in time.
+    Messages that still fail are reported back to SQS to be retried.
+    """
+    try:
+        start_log(context)
+        start_chat(context)
+        custom_print('[START] Starting Outbox')
+
+        headers = {'X-ChatWorkToken': os.environ['TOKEN']}
+        failures = []
+
+        for record in event['Records']:
+            message = json.loads(record['body'])
+            response = dispatch_chatwork(message['chatwork_url'], headers, message['body'])
+            if response is None or response.status >= 500 or response.status == 429:
+                failures.append({'itemIdentifier': record['messageId']})
+
+        custom_print('[FINISH] Sent ' + str(len(event['Records']) - len(failures)) + ' outbox messages, ' + str(len(failures)) + ' failed')
+        return {'batchItemFailures': failures}
+    finally:
+        # Ship the custom log before the container is frozen
+        flush_log()
+
+def claim_event(event_key):
+    """
+    Whether this is the first delivery of the event.
+    Keys already seen by this container are checked in memory first.
+    Then the key is written to IDEMPOTENCY_TABLE with a conditional
+    put, which fails when another delivery has already claimed it.
+    Without a table a dict of this container stands in (local runs and tests).
+
+    Parameters
+    event_key: str None is never a duplicate
+    """
+    if event_key is None:
+        return True
+
+    now = int(time.time())
+    with idempotency_lock:
+        if idempotency_memory.get(event_key, 0) > now:
+            return False
+
+    table_name = os.environ.get('IDEMPOTENCY_TABLE')
+    if table_name:
+        dynamodb_client = get_client('dynamodb')
+        try:
+            # An expired record may still exist until DynamoDB TTL removes it
+            dynamodb_client.put_item(
+                TableName=table_name,
+                Item={
+                    'event_key': {'S': event_key},
+                    'expires_at': {'N': str(now + IDEMPOTENCY_TTL)}
+                },
+                ConditionExpression='attribute_not_exists(event_key) OR expires_at < :now',
+                ExpressionAttributeValues={':now': {'N': str(now)}}
+            )
+            claimed = True
+        except dynamodb_client.exceptions.ConditionalCheckFailedException:
+            claimed = False
+    else:
+        with idempotency_lock:
+            claimed = idempotency_local_store.get(event_key, 0) <= now
+            if claimed:
+                idempotency_local_store[event_key] = now + IDEMPOTENCY_TTL
+
+    with idempotency_lock:
+        idempotency_memory[event_key] = now + IDEMPOTENCY_TTL
+        idempotency_memory.move_to_end(event_key)
+        while len(idempotency_memory) > IDEMPOTENCY_MEMORY_MAX:
+            idempotency_memory.popitem(last=False)
+    return claimed
+
+def release_event(event_key):
+    """
+    Forget a claimed event whose handling failed,
+    so that the next delivery is handled instead of dropped.
+
+    Parameters
+    event_key: str
+    """
+    if event_key is None:
+        return
+
+    with idempotency_lock:
+        idempotency_memory.pop(event_key, None)
+        idempotency_local_store.pop(event_key, None)
+
+    table_name = os.environ.get('IDEMPOTENCY_TABLE')
+    if table_name:
+        try:
+            get_client('dynamodb').delete_item(
+                TableName=table_name,
+                Key={'event_key': {'S': event_key}}
+            )
+        except Exception as error:
+            custom_print('[ERROR] Could not release ' + event_key + ': ' + str(error))
+
+def start_chat(context):
+    """
+    Remember until when this invocation may spend time on Chatwork retries.
+
+    Parameters
+    context: LambdaContext
+    """
+    global chat_deadline
+    if context is not None:
+        chat_deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - CHAT_DEADLINE_MARGIN
+    else:
+        chat_deadline = None
+
+def post_chatwork(chatwork_url, headers, body):
+    """
+    Post a message to the Chatwork room.
+    If it cannot be sent within the time left of this invocation
+    it is handed to the outbox queue instead of being lost.
+
+    Parameters
+    chatwork_url: str
+    headers: dict {TOKEN}
+    body: str message
+    """
+    response = dispatch_chatwork(chatwork_url, headers, body)
+    if response is None:
+        send_chat_outbox(chatwork_url, body)
+    return response
+
+def dispatch_chatwork(chatwork_url, headers, body):
+    """
+    Send a message while staying under the Chatwork rate limit.
+    Throttles with a token bucket and the quota Chatwork reports,
+    honours Retry-After and retries 429 and 5xx responses with
+    bounded backoff. Returns None if it could not be sent in time.
+
+    Parameters
+    chatwork_url: str
+    headers: dict {TOKEN}
+    body: str message
+    """
+    for attempt in range(CHAT_MAX_ATTEMPTS):
+        wait = reserve_chat_token()
+        if not chat_time_left(wait):
+            break
+        time.sleep(wait)
+
+        retry_after = None
+        try:
+            response = send_chatwork(chatwork_url, headers, body)
+        except urllib3.exceptions.HTTPError as error:
+            custom_print('[WARNING] Chatwork request failed: ' + str(error))
+        else:
+            update_chat_quota(response)
+            if response.status < 400:
+                return response
+            if response.status != 429 and response.status < 500:
+                custom_print('[ERROR] Chatwork responded ' + str(response.status) + ': ' + response.data.decode('utf-8', 'ignore'))
+                return response
+            custom_print('[WARNING] Chatwork responded ' + str(response.status) + ', attempt ' + str(attempt + 1))
+            retry_after = get_retry_after(response)
+
+        if retry_after is None:
+            retry_after = min(CHAT_BACKOFF_MAX, CHAT_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if not chat_time_left(retry_after):
+            break
+        time.sleep(retry_after)
+
+    return None
+
+def send_chatwork(chatwork_url, headers, body):
+    """
+    Post a message to the Chatwork room once.
+    Uses the pooled keep-alive connection, so only the first message
+    of a container pays for the TCP and TLS handshake.
+
+    Parameters
+    chatwork_url: str
+    headers: dict {TOKEN}
+    body: str message
+    """
+    request_headers = {
+        'Content-Type': 'application/x-www-form-urlencoded',
+        'Accept-Encoding': 'gzip'
+    }
+    request_headers.update(headers)
+
+    return chat_http.request(
+        'POST', chatwork_url,
+        body=urlencode({'body': body}),
+        headers=request_headers
+    )
+
+def reserve_chat_token():
+    """
+    Take a token from the bucket.
+    Returns the seconds to wait before the request may be sent.
+    """
+    with chat_lock:
+        now = time.time()
+        chat_bucket['tokens'] = min(
+            CHAT_RATE_BURST,
+            chat_bucket['tokens'] + (now - chat_bucket['updated']) * CHAT_RATE_PER_SECOND)
+        chat_bucket['updated'] = now
+        chat_bucket['tokens'] -= 1
+
+        wait = 0
+        if chat_bucket['tokens'] < 0:
+            wait = -chat_bucket['tokens'] / CHAT_RATE_PER_SECOND
+
+        # Chatwork said the quota is used up until the reset time
+        if chat_bucket['remaining'] == 0 and chat_bucket['reset'] > now:
+            wait = max(wait, chat_bucket['reset'] - now)
+        return wait
+
+def update_chat_quota(response):
+    """
+    Remember the quota reported by the rate limit headers of Chatwork.
+
+    Parameters
+    response: urllib3.HTTPResponse
+    """
+    remaining = response.headers.get('x-ratelimit-remaining')
+    reset = response.headers.get('x-ratelimit-reset')
+    with chat_lock:
+        if remaining is not None and remaining.isdigit():
+            chat_bucket['remaining'] = int(remaining)
+        if reset is not None and reset.isdigit():
+            chat_bucket['reset'] = int(reset)
+        if response.status == 429:
+            chat_bucket['remaining'] = 0
+
+def get_retry_after(response):
+    """
+    Seconds asked by the Retry-After header, or until the quota resets.
+
+    Parameters
+    response: urllib3.HTTPResponse
+    """
+    retry_after = response.headers.get('retry-after')
+    if retry_after is not None and retry_after.isdigit():
+        return int(retry_after)
+    if response.status == 429 and chat_bucket['reset'] > time.time():
+        return chat_bucket['reset'] - time.time()
+    return None
+
+def chat_time_left(wait):
+    """
+    Whether waiting the seconds still fits in this invocation.
+
+    Parameters
+    wait: float seconds
+    """
+    return chat_deadline is None or time.time() + wait < chat_deadline
+
+def send_chat_outbox(chatwork_url, body):
+    """
+    Hand a message that could not be sent to the outbox queue,
+    outbox_handler sends it again later.
+
+    Parameters
+    chatwork_url: str
+    body: str message
+    """
+    queue_url = os.environ.get('CHAT_OUTBOX_QUEUE_URL')
+    if not queue_url:
+        custom_print('[ERROR] Chatwork message was not sent and no outbox is configured:\n' + body)
+        return
+
+    try:
+        get_client('sqs').send_message(
+            QueueUrl=queue_url,
+            MessageBody=json.dumps({'chatwork_url': chatwork_url, 'body': body})
+        )
+        custom_print('[WARNING] Chatwork message was handed to the outbox')
+    except Exception as error:
+        custom_print('[ERROR] ' + str(error) + '\nChatwork message was lost:\n' + body)
+
+def get_instance_ids():
+    """
+    Instances to act on: INSTANCE_IDS, a comma separated list,
+    or the instances tagged as INSTANCE_TAGS, a JSON object of tag key
+    to a value or a list of values, or else the single INSTANCE_ID.
+    """
+    if os.environ.get('INSTANCE_IDS'):
+        return [instance_id.strip() for instance_id in os.environ['INSTANCE_IDS'].split(',') if instance_id.strip()]
+
+    if not os.environ.get('INSTANCE_TAGS'):
+        return [os.environ['INSTANCE_ID']]
+
+    filters = [{'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}]
+    for key, value in json.loads(os.environ['INSTANCE_TAGS']).items():
+        filters.append({'Name': 'tag:' + key, 'Values': value if isinstance(value, list) else [value]})
+
+    instance_ids = []
+    paginator = get_client('ec2', os.environ['AWS_REGION']).get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=filters):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                instance_ids.append(instance['InstanceId'])
+    return instance_ids
+
+def describe_instance_statuses(ec2_client, instance_ids):
+    """
+    State and status checks of the instances, EC2_STATUS_BATCH_MAX per call.
+    IncludeAllInstances also returns the instances that are not running.
+    Returns dict {instance id: {state, instance, system}}
+
+    Parameters
+    ec2_client: boto3 ec2 client
+    instance_ids: list [str]
+    """
+    statuses = {}
+    for index in range(0, len(instance_ids), EC2_STATUS_BATCH_MAX):
+        response = ec2_client.describe_instance_status(
+            InstanceIds=instance_ids[index:index + EC2_STATUS_BATCH_MAX],
+            IncludeAllInstances=True
+        )
+        for status in response['InstanceStatuses']:
+            statuses[status['InstanceId']] = {
+                'state': status['InstanceState']['Name'],
+                'instance': status['InstanceStatus']['Status'],
+                'system': status['SystemStatus']['Status']
+            }
+    return statuses
+
+def describe_instances_by_id(ec2_client, instance_ids):
+    """
+    Descriptions of the instances, EC2_STATUS_BATCH_MAX ids per call.
+    Returns dict {instance id: instance}
+
+    Parameters
+    ec2_client: boto3 ec2 client
+    instance_ids: list [str]
+    """
+    instances = {}
+    for index in range(0, len(instance_ids), EC2_STATUS_BATCH_MAX):
+        response = ec2_client.describe_instances(InstanceIds=instance_ids[index:index + EC2_STATUS_BATCH_MAX])
+        for reservation in response['Reservations']:
+            for instance in reservation['Instances']:
+                instances[instance['InstanceId']] = instance
+    return instances
+
+def format_instances(instance_ids, statuses, finished, paths=None):
+    """
+    One line per instance with its state, status checks, path taken and time taken.
+
+    Parameters
+    instance_ids: list [str]
+    statuses: dict {instance id: {state, instance, system}}
+    finished: dict {instance id: seconds taken}
+    paths: dict {instance id: str} how the instance was started or stopped
+    """
+    lines = []
+    for instance_id in instance_ids:
+        status = statuses.get(instance_id, {'state': 'unknown', 'instance': 'unknown', 'system': 'unknown'})
+        line = instance_id + ': ' + status['state'] + ', instance ' + status['instance'] + ', system ' + status['system']
+        if paths and instance_id in paths:
+            line += ', ' + paths[instance_id]
+        if instance_id in finished:
+            line += ', done in ' + str(int(finished[instance_id])) + ' seconds'
+        else:
+            line += ', not done'
+        lines.append(line)
+    return '\n'.join(lines)
+
+def emit_metric(namespace, name, seconds, dimensions):
+    """
+    Print one metric in CloudWatch Embedded Metric Format.
+    The line goes to the Lambda log group, where CloudWatch extracts the metric,
+    so it is printed as is instead of through custom_print.
+
+    Parameters
+    namespace: str CloudWatch namespace
+    name: str metric name
+    seconds: float
+    dimensions: dict {dimension name: value}
+    """
+    metric = {
+        '_aws': {
+            'Timestamp': int(round(time.time() * 1000)),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': 'Seconds'}]
+            }]
+        },
+        name: round(seconds, 3)
+    }
+    metric.update(dimensions)
+    print(json.dumps(metric, ensure_ascii=False))
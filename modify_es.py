@@ -9,35 +9,52 @@ and modify Elasticsearch instance via cron in UTC time.
 Change Detail: Change python version from 2.7 to 3.7 and local variables to environment variables
 """
 
-import json
 import os
-import time
 
-import boto3
+from lambda_common import custom_print, flush_log, get_client, set_log_projections, start_log
+
+# Fields of a payload written to the custom log, keyed by a top level key of the payload
+LOG_PROJECTIONS = {
+    'DomainStatus': [
+        ('DomainStatus', 'DomainName'), ('DomainStatus', 'ElasticsearchVersion'),
+        ('DomainStatus', 'Processing'), ('DomainStatus', 'UpgradeProcessing'),
+        ('DomainStatus', 'ElasticsearchClusterConfig')
+    ],
+    'DomainConfig': [
+        ('DomainConfig', 'ElasticsearchClusterConfig', 'Options'),
+        ('DomainConfig', 'ElasticsearchClusterConfig', 'Status', 'State')
+    ]
+}
+set_log_projections(LOG_PROJECTIONS)
 
 def lambda_handler(event, context):
     """
     lambda main
     """
-    custom_print('[START] Starting Script')
-
     try:
-        region = os.environ['AWS_REGION']
-        env = os.environ['ES_INSTANCE_NAME']
+        start_log(context)
+        custom_print('[START] Starting Script')
 
-        # Get Elasticsearch domain
-        es_domain_list = get_es_domain(region, env)
+        try:
+            region = os.environ['AWS_REGION']
+            env = os.environ['ES_INSTANCE_NAME']
 
-        # Modify the Elasticsearch Instance Type
-        modify_es_instance(region, es_domain_list)
+            # Get Elasticsearch domain
+            es_domain_list = get_es_domain(region, env)
 
-    except Exception as error:
-        custom_print('[ERROR] ' + str(error))
-        return 2
+            # Modify the Elasticsearch Instance Type
+            modify_es_instance(region, es_domain_list)
+
+        except Exception as error:
+            custom_print('[ERROR] ' + str(error))
+            return 2
 
-    custom_print('[FINISH] Finished running script')
+        custom_print('[FINISH] Finished running script')
 
-    return 0
+        return 0
+    finally:
+        # Ship the custom log before the container is frozen
+        flush_log()
 
 def get_es_domain(region, env):
     """
@@ -50,7 +67,7 @@ def get_es_domain(region, env):
     """
     try:
 
-        es_client = boto3.client('es', region_name=region)
+        es_client = get_client('es', region)
 
         custom_print('[INFO] Retrieving list of es domains for ' + str(env))
         response = es_client.list_domain_names()
@@ -80,7 +97,7 @@ def modify_es_instance(region, es_domain_list):
     -----------
     """
     try:
-        es_client = boto3.client('es', region_name=region)
+        es_client = get_client('es', region)
 
         for es_domain in es_domain_list:
             es_domain_name = es_domain
@@ -104,69 +121,7 @@ def modify_es_instance(region, es_domain_list):
         custom_print('[ERROR] ' + str(error))
         return 2
 
-def custom_print(msg):
-    """
-    AWS Lambda does not put logs in continous matter.
-    If you want to have a continous log, you need to create
-    your own log and put it inside that log.
-    Also, this will determine is the response is JSON
-    and print it in JSON format for easier read.
-
-    Parameters
-    msg: str
-    """
-    # If the message is a json format, print the result in json
-    # to make it easier to read.
-    if isinstance(msg, str):
-        msg = msg
-        print(msg)
-    else:
-        msgjson = json.dumps(msg, sort_keys=True, default=str)
-        msg = '[RESPONSE]\n' + msgjson
-        print('[RESPONSE] ' + msgjson)
-    # Time since EPOCH
-    time_stamp_milli = int(round(time.time() * 1000))
-
-    # Initialize
-    log_group_name = os.environ['CUSTOM_LOG_GROUP']
-    log_stream_name = os.environ['CUSTOM_LOG_STREAM']
-    region = os.environ['AWS_REGION']
-    log_client = boto3.client('logs', region_name=region)
-
-    # Obtain the response and check if token exists
-    log_response = log_client.describe_log_streams(
-        logGroupName=log_group_name,
-        logStreamNamePrefix=log_stream_name)['logStreams'][0]
-    found = 0
-    for key in log_response.keys():
-        if key == 'uploadSequenceToken':
-            found = 1
-
-    # If token does exists, the log already has entry; append to the log with token
-    if found:
-        upload_token = log_client.describe_log_streams(
-            logGroupName=log_group_name,
-            logStreamNamePrefix=log_stream_name)['logStreams'][0]['uploadSequenceToken']
-        response = log_client.put_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream_name,
-            logEvents=[
-                {
-                    'timestamp': time_stamp_milli,
-                    'message': msg
-                }
-            ],
-            sequenceToken=upload_token
-        )
-    # This log entry is absolutely new, therefore no need of token
-    else:
-        response = log_client.put_log_events(
-            logGroupName=log_group_name,
-            logStreamName=log_stream_name,
-            logEvents=[
-                {
-                    'timestamp': time_stamp_milli,
-                    'message': msg
-                }
-            ]
-        )
+# Build the clients during the init phase so it falls outside billed duration
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    for init_service in ('logs', 'es'):
+        get_client(init_service)
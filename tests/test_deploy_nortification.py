@@ -0,0 +1,61 @@
+"""
+Tests of the CodeDeploy polling of deploy_nortification.
+"""
+
+import unittest
+from unittest import mock
+
+import deploy_nortification
+
+PROFILE = {'expected': 60, 'min_interval': 2, 'max_interval': 15}
+
+
+class PollUntilTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.slept = []
+        for patcher in (
+            mock.patch.object(deploy_nortification.time, 'time', lambda: self.now),
+            mock.patch.object(deploy_nortification.time, 'sleep', self.sleep),
+            mock.patch.object(deploy_nortification.random, 'uniform', lambda low, high: 1.0)
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def poll(self, results, deadline, profile=PROFILE):
+        check = mock.Mock(side_effect=results)
+        result = deploy_nortification.poll_until(check, lambda status: status == 'done', self.now, deadline, profile)
+        return result, check.call_count
+
+    def test_first_check_is_immediate(self):
+        self.assertEqual(self.poll(['done'], self.now + 240), ('done', 1))
+        self.assertEqual(self.slept, [])
+
+    def test_interval_backs_off_up_to_max_interval(self):
+        profile = {'expected': 1000, 'min_interval': 2, 'max_interval': 15}
+        self.poll(['running'] * 5 + ['done'], self.now + 240, profile)
+        self.assertEqual(self.slept, [4, 8, 15, 15, 15])
+
+    def test_interval_drops_to_min_interval_around_the_expected_duration(self):
+        profile = {'expected': 35, 'min_interval': 2, 'max_interval': 15}
+        self.poll(['running'] * 6 + ['done'], self.now + 240, profile)
+        self.assertEqual(self.slept, [4, 8, 15, 2, 2, 2])
+
+    def test_deadline_returns_the_last_result(self):
+        result, attempts = self.poll(['running'] * 100, self.now + 20)
+        self.assertEqual(result, 'running')
+        self.assertEqual(self.now, 1020.0)
+        # The last wait is cut short at the deadline
+        self.assertEqual(self.slept, [4, 8, 8])
+
+    def test_deadline_in_the_past_checks_once(self):
+        self.assertEqual(self.poll(['running', 'done'], self.now), ('running', 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Tests of the pre-warm lead of ec2_start, planned from the boot history stand-in.
+"""
+
+import os
+import unittest
+from unittest import mock
+
+import ec2_start
+
+
+class GetPrewarmLeadTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop('BOOT_HISTORY_TABLE', None)
+        os.environ.pop('PREWARM_PERCENTILE', None)
+
+        ec2_start.boot_history_local_store.clear()
+
+    def record(self, path, seconds_list):
+        for seconds in seconds_list:
+            ec2_start.record_boot_history('i-1', seconds, path)
+
+    def test_instance_without_history_uses_the_default_lead(self):
+        self.assertEqual(ec2_start.get_prewarm_lead('i-1', 'boot'), ec2_start.PREWARM_DEFAULT_LEAD)
+
+    def test_lead_is_the_percentile_plus_the_margin(self):
+        self.record('boot', [100 + index for index in range(10)])
+        self.assertEqual(ec2_start.get_prewarm_lead('i-1', 'boot'), 108 + ec2_start.PREWARM_MARGIN)
+
+    def test_percentile_is_configurable(self):
+        os.environ['PREWARM_PERCENTILE'] = '50'
+        self.record('boot', [100 + index for index in range(10)])
+        self.assertEqual(ec2_start.get_prewarm_lead('i-1', 'boot'), 104 + ec2_start.PREWARM_MARGIN)
+
+    def test_fractional_time_is_rounded_up(self):
+        self.record('boot', [90.2])
+        self.assertEqual(ec2_start.get_prewarm_lead('i-1', 'boot'), 91 + ec2_start.PREWARM_MARGIN)
+
+    def test_only_times_of_the_same_path_are_used(self):
+        self.record('boot', [100, 110])
+        self.record('resume', [20, 30])
+        self.assertEqual(ec2_start.get_prewarm_lead('i-1', 'boot'), 110 + ec2_start.PREWARM_MARGIN)
+        self.assertEqual(ec2_start.get_prewarm_lead('i-1', 'resume'), 30 + ec2_start.PREWARM_MARGIN)
+
+    def test_path_without_history_uses_the_default_lead(self):
+        self.record('boot', [100])
+        self.assertEqual(ec2_start.get_prewarm_lead('i-1', 'resume'), ec2_start.PREWARM_DEFAULT_LEAD)
+
+    def test_only_the_latest_times_are_kept(self):
+        with mock.patch.object(ec2_start, 'BOOT_HISTORY_SIZE', 3):
+            self.record('boot', [500, 100, 110, 120])
+        self.assertEqual(ec2_start.get_prewarm_lead('i-1', 'boot'), 120 + ec2_start.PREWARM_MARGIN)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Tests of the idle detection of ec2_stop from the CloudWatch datapoints.
+"""
+
+import os
+import unittest
+from unittest import mock
+
+import ec2_stop
+
+EXPECTED = ec2_stop.IDLE_WINDOW // ec2_stop.IDLE_PERIOD - 1
+
+
+class GetIdleInstancesTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in ('IDLE_CPU_PERCENT', 'IDLE_NETWORK_BYTES', 'IDLE_AGENT_METRIC', 'IDLE_AGENT_THRESHOLD'):
+            os.environ.pop(name, None)
+
+        self.values = {}
+        patcher = mock.patch.object(ec2_stop, 'get_metric_values', self.get_metric_values)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_metric_values(self, queries, start_time, end_time):
+        self.queries = queries
+        return self.values
+
+    def set_values(self, index, cpu=1.0, netin=1024.0, netout=1024.0, count=EXPECTED):
+        self.values['cpu_' + str(index)] = [cpu] * count
+        self.values['netin_' + str(index)] = [netin] * count
+        self.values['netout_' + str(index)] = [netout] * count
+
+    def test_quiet_instance_is_idle(self):
+        self.set_values(0)
+        self.assertEqual(ec2_stop.get_idle_instances(['i-1']), ['i-1'])
+
+    def test_busy_cpu_or_network_is_not_idle(self):
+        self.set_values(0, cpu=50.0)
+        self.set_values(1, netout=ec2_stop.IDLE_NETWORK_BYTES + 1)
+        self.set_values(2)
+        self.assertEqual(ec2_stop.get_idle_instances(['i-1', 'i-2', 'i-3']), ['i-3'])
+
+    def test_one_busy_period_is_not_idle(self):
+        self.set_values(0)
+        self.values['cpu_0'][3] = 90.0
+        self.assertEqual(ec2_stop.get_idle_instances(['i-1']), [])
+
+    def test_missing_datapoints_are_not_idle(self):
+        self.set_values(0, count=EXPECTED - 1)
+        self.set_values(1)
+        del self.values['netin_1']
+        self.assertEqual(ec2_stop.get_idle_instances(['i-1', 'i-2']), [])
+
+    def test_thresholds_are_configurable(self):
+        os.environ['IDLE_CPU_PERCENT'] = '60'
+        self.set_values(0, cpu=50.0)
+        self.assertEqual(ec2_stop.get_idle_instances(['i-1']), ['i-1'])
+
+    def test_agent_metric_is_checked_when_set(self):
+        os.environ['IDLE_AGENT_METRIC'] = 'SessionCount'
+        self.set_values(0)
+        self.set_values(1)
+        self.values['agent_0'] = [0.0] * EXPECTED
+        self.values['agent_1'] = [1.0] * EXPECTED
+        self.assertEqual(ec2_stop.get_idle_instances(['i-1', 'i-2']), ['i-1'])
+
+        agent_queries = [query for query in self.queries if query['Id'].startswith('agent_')]
+        self.assertEqual(agent_queries[0]['MetricStat']['Metric']['Namespace'], 'CWAgent')
+        self.assertEqual(agent_queries[0]['MetricStat']['Metric']['MetricName'], 'SessionCount')
+
+    def test_query_ids_start_with_a_lower_case_letter(self):
+        self.set_values(0)
+        ec2_stop.get_idle_instances(['i-1'])
+        self.assertEqual(sorted(query['Id'] for query in self.queries), ['cpu_0', 'netin_0', 'netout_0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+"""
+Tests of the idempotency store, the custom log batches and the Chatwork
+rate limiting of lambda_common, run against the in-container stand-ins.
+"""
+
+import os
+import time
+import unittest
+from unittest import mock
+
+import urllib3
+
+import lambda_common
+
+
+class ClaimEventTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop('IDEMPOTENCY_TABLE', None)
+
+        lambda_common.idempotency_memory.clear()
+        lambda_common.idempotency_local_store.clear()
+
+    def test_first_delivery_is_claimed(self):
+        self.assertTrue(lambda_common.claim_event('event:1'))
+
+    def test_duplicate_delivery_is_dropped(self):
+        lambda_common.claim_event('event:1')
+        self.assertFalse(lambda_common.claim_event('event:1'))
+        self.assertTrue(lambda_common.claim_event('event:2'))
+
+    def test_duplicate_is_dropped_by_the_store_after_memory_eviction(self):
+        lambda_common.claim_event('event:1')
+        lambda_common.idempotency_memory.clear()
+        self.assertFalse(lambda_common.claim_event('event:1'))
+
+    def test_expired_claim_is_claimed_again(self):
+        lambda_common.claim_event('event:1')
+        expired = int(time.time()) - 1
+        lambda_common.idempotency_memory['event:1'] = expired
+        lambda_common.idempotency_local_store['event:1'] = expired
+        self.assertTrue(lambda_common.claim_event('event:1'))
+
+    def test_event_without_key_is_never_a_duplicate(self):
+        self.assertTrue(lambda_common.claim_event(None))
+        self.assertTrue(lambda_common.claim_event(None))
+
+    def test_memory_keeps_the_latest_keys(self):
+        with mock.patch.object(lambda_common, 'IDEMPOTENCY_MEMORY_MAX', 2):
+            for index in range(3):
+                lambda_common.claim_event('event:' + str(index))
+        self.assertEqual(list(lambda_common.idempotency_memory), ['event:1', 'event:2'])
+
+    def test_released_event_is_handled_again(self):
+        lambda_common.claim_event('event:1')
+        lambda_common.release_event('event:1')
+        self.assertTrue(lambda_common.claim_event('event:1'))
+
+    def test_release_without_key_does_nothing(self):
+        lambda_common.claim_event('event:1')
+        lambda_common.release_event(None)
+        self.assertFalse(lambda_common.claim_event('event:1'))
+
+
+class SplitLogBatchesTest(unittest.TestCase):
+
+    def test_events_within_the_limits_are_one_batch(self):
+        events = [{'timestamp': 1000 + index, 'message': 'm' + str(index)} for index in range(3)]
+        self.assertEqual(list(lambda_common.split_log_batches(events)), [events])
+
+    def test_no_events_make_no_batch(self):
+        self.assertEqual(list(lambda_common.split_log_batches([])), [])
+
+    def test_batches_are_split_by_count(self):
+        events = [{'timestamp': 1000, 'message': 'm'} for index in range(5)]
+        with mock.patch.object(lambda_common, 'LOG_BATCH_MAX_COUNT', 2):
+            batches = list(lambda_common.split_log_batches(events))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+    def test_batches_are_split_by_bytes_with_the_event_overhead(self):
+        # 'ああ' is 6 bytes of UTF-8, 32 bytes with the overhead
+        events = [{'timestamp': 1000, 'message': 'ああ'} for index in range(3)]
+        with mock.patch.object(lambda_common, 'LOG_BATCH_MAX_BYTES', 64):
+            batches = list(lambda_common.split_log_batches(events))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+
+    def test_batches_are_split_by_time_span(self):
+        span = lambda_common.LOG_BATCH_MAX_SPAN
+        events = [
+            {'timestamp': 0, 'message': 'a'},
+            {'timestamp': span - 1, 'message': 'b'},
+            {'timestamp': span, 'message': 'c'}
+        ]
+        batches = list(lambda_common.split_log_batches(events))
+        self.assertEqual([[log_event['message'] for log_event in batch] for batch in batches], [['a', 'b'], ['c']])
+
+
+def chat_response(status, headers=None):
+    return mock.Mock(status=status, headers=headers or {}, data=b'{}')
+
+
+class ChatRateLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000000.0
+        self.slept = []
+        for patcher in (
+            mock.patch.object(lambda_common.time, 'time', lambda: self.now),
+            mock.patch.object(lambda_common.time, 'sleep', self.sleep),
+            mock.patch.object(lambda_common.random, 'uniform', lambda low, high: high),
+            mock.patch.object(lambda_common, 'chat_deadline', None),
+            mock.patch.dict(lambda_common.chat_bucket, {
+                'tokens': lambda_common.CHAT_RATE_BURST, 'updated': self.now, 'remaining': None, 'reset': 0
+            })
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def test_burst_is_sent_without_waiting(self):
+        waits = [lambda_common.reserve_chat_token() for index in range(lambda_common.CHAT_RATE_BURST)]
+        self.assertEqual(waits, [0] * lambda_common.CHAT_RATE_BURST)
+
+    def test_requests_past_the_burst_wait_for_a_token(self):
+        for index in range(lambda_common.CHAT_RATE_BURST):
+            lambda_common.reserve_chat_token()
+        self.assertEqual(lambda_common.reserve_chat_token(), 1 / lambda_common.CHAT_RATE_PER_SECOND)
+        self.assertEqual(lambda_common.reserve_chat_token(), 2 / lambda_common.CHAT_RATE_PER_SECOND)
+
+    def test_tokens_refill_over_time(self):
+        for index in range(lambda_common.CHAT_RATE_BURST):
+            lambda_common.reserve_chat_token()
+        self.now += 3 / lambda_common.CHAT_RATE_PER_SECOND
+        self.assertEqual(lambda_common.reserve_chat_token(), 0)
+
+    def test_used_up_quota_waits_until_the_reset(self):
+        lambda_common.update_chat_quota(chat_response(200, {
+            'x-ratelimit-remaining': '0', 'x-ratelimit-reset': str(int(self.now) + 40)
+        }))
+        self.assertEqual(lambda_common.reserve_chat_token(), 40)
+
+    def test_server_errors_are_retried_with_backoff(self):
+        responses = [chat_response(503), chat_response(502), chat_response(200)]
+        with mock.patch.object(lambda_common, 'send_chatwork', side_effect=responses) as send:
+            response = lambda_common.dispatch_chatwork('url', {}, 'body')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(send.call_count, 3)
+        self.assertEqual(self.slept, [0, lambda_common.CHAT_BACKOFF_BASE, 0, lambda_common.CHAT_BACKOFF_BASE * 2, 0])
+
+    def test_backoff_is_bounded(self):
+        with mock.patch.object(lambda_common, 'send_chatwork', return_value=chat_response(500)), \
+                mock.patch.object(lambda_common, 'CHAT_BACKOFF_MAX', 3):
+            self.assertIsNone(lambda_common.dispatch_chatwork('url', {}, 'body'))
+        backoffs = self.slept[1::2]
+        self.assertEqual(len(backoffs), lambda_common.CHAT_MAX_ATTEMPTS)
+        self.assertEqual(max(backoffs), 3)
+
+    def test_retry_after_is_honoured(self):
+        responses = [chat_response(429, {'retry-after': '7'}), chat_response(200)]
+        with mock.patch.object(lambda_common, 'send_chatwork', side_effect=responses):
+            lambda_common.dispatch_chatwork('url', {}, 'body')
+        self.assertEqual(self.slept[1], 7)
+
+    def test_connection_errors_are_retried(self):
+        responses = [urllib3.exceptions.HTTPError('reset'), chat_response(200)]
+        with mock.patch.object(lambda_common, 'send_chatwork', side_effect=responses) as send:
+            self.assertEqual(lambda_common.dispatch_chatwork('url', {}, 'body').status, 200)
+        self.assertEqual(send.call_count, 2)
+
+    def test_client_errors_are_not_retried(self):
+        with mock.patch.object(lambda_common, 'send_chatwork', return_value=chat_response(400)) as send:
+            self.assertEqual(lambda_common.dispatch_chatwork('url', {}, 'body').status, 400)
+        self.assertEqual(send.call_count, 1)
+
+    def test_gives_up_when_the_wait_does_not_fit_the_invocation(self):
+        deadline = self.now + 1.5
+        with mock.patch.object(lambda_common, 'chat_deadline', deadline), \
+                mock.patch.object(lambda_common, 'send_chatwork', return_value=chat_response(500)) as send:
+            self.assertIsNone(lambda_common.dispatch_chatwork('url', {}, 'body'))
+        self.assertEqual(send.call_count, 2)
+        self.assertLess(self.now, deadline)
+
+
+if __name__ == '__main__':
+    unittest.main()